@@ -0,0 +1,34 @@
+"""lower(email) indexes on sqlite
+
+Revision ID: 3e8b1d5f7a26
+Revises: a9d3f61c2b74
+Create Date: 2026-10-18 18:03:44.160529
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3e8b1d5f7a26'
+down_revision = 'a9d3f61c2b74'
+branch_labels = None
+depends_on = None
+
+USER_TABLES = ['staff_users', 'teacher_users', 'student_users']
+
+
+def upgrade():
+    # sqlite compares with a case-sensitive collation like postgres, so it also looks emails up
+    # on lower(email) and needs the same expression indexes
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for table in USER_TABLES:
+        op.create_index('ix_{}_email_lower'.format(table), table, [sa.text('lower(email)')], unique=False)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for table in USER_TABLES:
+        op.drop_index('ix_{}_email_lower'.format(table), table_name=table)
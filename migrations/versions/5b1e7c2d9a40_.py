@@ -0,0 +1,34 @@
+"""case-insensitive email indexes for /login
+
+Revision ID: 5b1e7c2d9a40
+Revises: f3a88486691e
+Create Date: 2026-10-18 10:12:31.482113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1e7c2d9a40'
+down_revision = 'f3a88486691e'
+branch_labels = None
+depends_on = None
+
+USER_TABLES = ['staff_users', 'teacher_users', 'student_users']
+
+
+def upgrade():
+    # MySQL compares emails with a case-insensitive collation, so the app looks them up on
+    # the bare column and the existing unique index serves it. Postgres needs an expression index.
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for table in USER_TABLES:
+        op.create_index('ix_{}_email_lower'.format(table), table, [sa.text('lower(email)')], unique=False)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for table in USER_TABLES:
+        op.drop_index('ix_{}_email_lower'.format(table), table_name=table)
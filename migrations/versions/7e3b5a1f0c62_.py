@@ -0,0 +1,79 @@
+"""numeric money columns
+
+Revision ID: 7e3b5a1f0c62
+Revises: 2f6a9d4c8e15
+Create Date: 2026-10-18 12:31:45.903781
+
+"""
+import re
+from decimal import Decimal, InvalidOperation
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e3b5a1f0c62'
+down_revision = '2f6a9d4c8e15'
+branch_labels = None
+depends_on = None
+
+MONEY_COLUMNS = [
+    ('payments', 'amount'),
+    ('invoices', 'amount'),
+    ('credit_notes', 'amount'),
+    ('financing_agreements', 'monthlyFee'),
+]
+BATCH_SIZE = 1000
+THOUSANDS_WITH_DOTS = re.compile(r'^-?\d{1,3}(\.\d{3})+$')
+
+
+# same rules as utils.parse_money, copied so the migration does not depend on the app code
+def parse_money(value):
+    text = (value or '').replace('$', '').replace(' ', '').strip()
+    if '.' in text and ',' in text:
+        text = text.replace('.', '').replace(',', '.')
+    elif ',' in text:
+        text = text.replace(',', '.')
+    elif THOUSANDS_WITH_DOTS.match(text):
+        text = text.replace('.', '')
+    try:
+        amount = Decimal(text)
+    except InvalidOperation:
+        return None
+    return amount if amount.is_finite() else None
+
+
+def convert(table_name, column, new_type, old_type, cast):
+    bind = op.get_bind()
+    tmp = column + '_tmp'
+    op.add_column(table_name, sa.Column(tmp, new_type, nullable=True))
+
+    table = sa.table(table_name, sa.column('id', sa.Integer), sa.column(column, old_type), sa.column(tmp, new_type))
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select([table.c.id, table.c[column]]).where(table.c.id > last_id).order_by(table.c.id).limit(BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        batch = []
+        for row_id, value in rows:
+            converted = cast(value)
+            if converted is None:
+                raise ValueError('{}.{} of row {} is not an amount: {!r}'.format(table_name, column, row_id, value))
+            batch.append({'row_id': row_id, 'converted': converted})
+        bind.execute(table.update().where(table.c.id == sa.bindparam('row_id')).values({tmp: sa.bindparam('converted')}), batch)
+        last_id = rows[-1][0]
+
+    op.drop_column(table_name, column)
+    op.alter_column(table_name, tmp, new_column_name=column, existing_type=new_type, nullable=False)
+
+
+def upgrade():
+    for table_name, column in MONEY_COLUMNS:
+        convert(table_name, column, sa.Numeric(14, 2), sa.String(length=100), parse_money)
+
+
+def downgrade():
+    for table_name, column in MONEY_COLUMNS:
+        convert(table_name, column, sa.String(length=100), sa.Numeric(14, 2), lambda value: None if value is None else str(value))
@@ -0,0 +1,114 @@
+"""canonical rut columns
+
+Revision ID: c81f0d3e5a27
+Revises: 4a8c6e2b7d91
+Create Date: 2026-10-18 14:05:52.771064
+
+"""
+import re
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81f0d3e5a27'
+down_revision = '4a8c6e2b7d91'
+branch_labels = None
+depends_on = None
+
+# (table, column, unique) of every column that references profiles.rut
+REFERENCING = [
+    ('financing_agreements', 'rut', True),
+    ('payments', 'rut', False),
+    ('invoices', 'rut', False),
+    ('credit_notes', 'rut', False),
+    ('ruts', 'rut_id', True),
+]
+BATCH_SIZE = 1000
+RUT_PATTERN = re.compile(r'^0*(\d{1,8})([0-9K])$')
+
+
+# same rules as rut.normalize_rut, copied so the migration does not depend on the app code
+def check_digit(body):
+    total = 0
+    factor = 2
+    for digit in reversed(body):
+        total += int(digit) * factor
+        factor = factor + 1 if factor < 7 else 2
+    rest = 11 - total % 11
+    return {11: '0', 10: 'K'}.get(rest, str(rest))
+
+
+def normalize_rut(value):
+    text = str(value).strip().upper().replace('.', '').replace('-', '').replace(' ', '')
+    match = RUT_PATTERN.match(text)
+    if not match or check_digit(match.group(1)) != match.group(2):
+        return None
+    return '{}-{}'.format(*match.groups())
+
+
+def rewrite(table_name, column):
+    bind = op.get_bind()
+    table = sa.table(table_name, sa.column('id', sa.Integer), sa.column(column, sa.String))
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select([table.c.id, table.c[column]]).where(table.c.id > last_id).order_by(table.c.id).limit(BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        batch = []
+        for row_id, value in rows:
+            rut = normalize_rut(value)
+            if rut is None:
+                raise ValueError('{}.{} of row {} is not a valid rut: {!r}'.format(table_name, column, row_id, value))
+            if rut != value:
+                batch.append({'row_id': row_id, 'rut': rut})
+        if batch:
+            bind.execute(table.update().where(table.c.id == sa.bindparam('row_id')).values({column: sa.bindparam('rut')}), batch)
+        last_id = rows[-1][0]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    # the foreign keys have backend generated names, look them up before touching the columns
+    for table_name, column, unique in REFERENCING:
+        for fk in inspector.get_foreign_keys(table_name):
+            if fk['referred_table'] == 'profiles' and fk['constrained_columns'] == [column]:
+                op.drop_constraint(fk['name'], table_name, type_='foreignkey')
+        if not unique:
+            # payments, invoices and credit notes are many per rut
+            for constraint in inspector.get_unique_constraints(table_name):
+                if constraint['column_names'] == [column]:
+                    op.drop_constraint(constraint['name'], table_name, type_='unique')
+
+    for table_name, column, unique in REFERENCING:
+        op.alter_column(table_name, column, type_=sa.String(length=100), existing_nullable=False,
+                        postgresql_using='{}::varchar(100)'.format(column))
+
+    rewrite('profiles', 'rut')
+    for table_name, column, unique in REFERENCING:
+        rewrite(table_name, column)
+
+    op.alter_column('profiles', 'rut', type_=sa.String(length=12), existing_type=sa.String(length=100), existing_nullable=False)
+    for table_name, column, unique in REFERENCING:
+        op.alter_column(table_name, column, type_=sa.String(length=12), existing_type=sa.String(length=100), existing_nullable=False)
+        if not unique:
+            op.create_index(op.f('ix_{}_{}'.format(table_name, column)), table_name, [column], unique=False)
+        op.create_foreign_key('fk_{}_{}_profiles'.format(table_name, column), table_name, 'profiles', [column], ['rut'])
+
+
+def downgrade():
+    # canonical ruts carry a dash, so the old integer columns come back as text
+    for table_name, column, unique in REFERENCING:
+        op.drop_constraint('fk_{}_{}_profiles'.format(table_name, column), table_name, type_='foreignkey')
+        if not unique:
+            op.drop_index(op.f('ix_{}_{}'.format(table_name, column)), table_name=table_name)
+
+    op.alter_column('profiles', 'rut', type_=sa.String(length=100), existing_type=sa.String(length=12), existing_nullable=False)
+    for table_name, column, unique in REFERENCING:
+        op.alter_column(table_name, column, type_=sa.String(length=100), existing_type=sa.String(length=12), existing_nullable=False)
+        if not unique:
+            op.create_unique_constraint(None, table_name, [column])
+        op.create_foreign_key(None, table_name, 'profiles', [column], ['rut'])
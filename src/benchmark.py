@@ -0,0 +1,135 @@
+"""
+Throughput of the ORM serialize() path against the Core row path the read endpoints use, and the
+cost of the cohort finance report, measured on throwaway in-memory SQLite databases so real data
+is never touched
+"""
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from flask import json
+from models import db, Profile, TeacherAnswer, Financing, Payment
+from reports import cohort_financial_report
+from utils import select_fields, row_serializer, fetch_rows, dumps, orjson
+
+BENCHMARK_MODELS = [Profile, TeacherAnswer]
+
+def fake_rows(model, count):
+    if model is Profile:
+        return [{
+            "id": i,
+            "student_id": i,
+            "breathecode_id": i,
+            "name": "Name {}".format(i),
+            "lastName": "Last Name {}".format(i),
+            "email": "student{}@example.com".format(i),
+            "size": "M",
+            "address": "Avenida Siempre Viva {}".format(i),
+            "phone": "+5699{:07d}".format(i),
+            "cohort": "santiago-{}".format(i % 40),
+            "rut": "{}-K".format(10000000 + i)
+        } for i in range(1, count + 1)]
+
+    now = datetime.utcnow()
+    return [{
+        "id": i,
+        "teacher_question_id": i % 30 + 1,
+        "answer": str(i % 5 + 1),
+        "breathecode_id": i % 2000 + 1,
+        "date": now - timedelta(minutes=i),
+        "questionnarie_id": i % 10 + 1,
+        "teacher_user": i % 50 + 1
+    } for i in range(1, count + 1)]
+
+def orm_path(session, model):
+    # what the list endpoints did before: full entities, serialize() and the stdlib encoder
+    items = session.query(model).order_by(model.id).all()
+    return json.dumps([item.serialize() for item in items]).encode('utf-8')
+
+def row_path(session, model):
+    fields = list(model.FIELDS)
+    serialize = row_serializer(model, fields)
+    query = select_fields(session.query(model), model, fields).order_by(model.id)
+    return dumps([serialize(row) for row in fetch_rows(query)])
+
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def serialization_benchmark(rows=50000, repeat=3):
+    engine = create_engine('sqlite://')
+    db.metadata.create_all(engine, tables=[model.__table__ for model in BENCHMARK_MODELS])
+    session = sessionmaker(bind=engine)()
+
+    results = []
+    for model in BENCHMARK_MODELS:
+        engine.execute(model.__table__.insert(), fake_rows(model, rows))
+        orm = best_time(lambda: orm_path(session, model), repeat)
+        core = best_time(lambda: row_path(session, model), repeat)
+        results.append({
+            "table": model.__tablename__,
+            "rows": rows,
+            "orm_rows_per_s": int(rows / orm),
+            "core_rows_per_s": int(rows / core),
+            "speedup": round(orm / core, 2),
+            "encoder": "orjson" if orjson is not None else "json"
+        })
+
+    session.close()
+    engine.dispose()
+    return results
+
+def report_fixture(students):
+    # every student has a 6 to 12 month plan started over two years and pays its first installments
+    start = datetime(2023, 1, 1)
+    financings = []
+    payments = []
+    for i in range(1, students + 1):
+        date = start + timedelta(days=i % 730)
+        months = 6 + i % 7
+        financings.append({
+            "id": i,
+            "months": months,
+            "monthlyFee": Decimal(100000 + i % 5 * 25000),
+            "date": date,
+            "rut": "{}-K".format(10000000 + i),
+            "urlPDF": ""
+        })
+        for number in range(1, min(months, 3 + i % 4) + 1):
+            payments.append({
+                "date": date + timedelta(days=30 * number),
+                "amount": Decimal(100000 + i % 5 * 25000),
+                "urlPDF": "",
+                "payment_method": "transfer",
+                "bank": "",
+                "rut": "{}-K".format(10000000 + i)
+            })
+    return financings, payments
+
+def report_benchmark(students=100000, repeat=3):
+    engine = create_engine('sqlite://')
+    db.metadata.create_all(engine, tables=[Profile.__table__, Financing.__table__, Payment.__table__])
+    session = sessionmaker(bind=engine)()
+
+    financings, payments = report_fixture(students)
+    engine.execute(Profile.__table__.insert(), fake_rows(Profile, students))
+    engine.execute(Financing.__table__.insert(), financings)
+    engine.execute(Payment.__table__.insert(), payments)
+
+    until = datetime(2025, 6, 15)
+    elapsed = best_time(lambda: cohort_financial_report(until, session), repeat)
+    result = {
+        "students": students,
+        "payments": len(payments),
+        "cohorts": len(cohort_financial_report(until, session)),
+        "seconds": round(elapsed, 3)
+    }
+
+    session.close()
+    engine.dispose()
+    return result
@@ -0,0 +1,138 @@
+"""
+Read-through cache for serialized entities, in process (LRU + TTL) or shared by the workers of a host (SQLite file)
+"""
+import os
+import time
+import random
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+from flask import json
+
+class MemoryBackend:
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def size(self):
+        return len(self._entries)
+
+class SQLiteBackend:
+    # every gunicorn worker reads and invalidates the same file, so a write in one
+    # worker is seen by the others right away instead of after the TTL
+
+    def __init__(self, path, max_size=10000):
+        self.path = path
+        self.max_size = max_size
+        self.evictions = 0
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute("SELECT value FROM entries WHERE key = ? AND expires >= ?", (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        conn = self._connection()
+        conn.execute("INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)", (key, json.dumps(value), time.time() + ttl))
+        if random.random() < 0.01:
+            self._prune(conn)
+
+    def _prune(self, conn):
+        expired = conn.execute("DELETE FROM entries WHERE expires < ?", (time.time(),)).rowcount
+        overflow = conn.execute(
+            "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY expires LIMIT max(0, (SELECT count(*) FROM entries) - ?))",
+            (self.max_size,)
+        ).rowcount
+        self.evictions += expired + overflow
+
+    def delete(self, keys):
+        keys = list(keys)
+        if keys:
+            self._connection().execute("DELETE FROM entries WHERE key IN ({})".format(",".join("?" * len(keys))), keys)
+
+    def size(self):
+        return self._connection().execute("SELECT count(*) FROM entries").fetchone()[0]
+
+class EntityCache:
+
+    def __init__(self, backend, ttl=60):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls):
+        ttl = int(os.environ.get('ENTITY_CACHE_TTL', 60))
+        max_size = int(os.environ.get('ENTITY_CACHE_SIZE', 10000))
+        if os.environ.get('ENTITY_CACHE_BACKEND') == 'sqlite':
+            path = os.environ.get('ENTITY_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'entity_cache.sqlite3'))
+            return cls(SQLiteBackend(path, max_size), ttl)
+        return cls(MemoryBackend(max_size), ttl)
+
+    def get_or_load(self, key, loader, ttl=None, version=None):
+        # loader returns the serialized entity or None; misses of the database are not cached.
+        # Entries remember the version they were loaded at and one stored at another version is a
+        # miss, so a write made through another worker is never served from this one.
+        entry = self.backend.get(key)
+        if isinstance(entry, list) and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = loader()
+        if value is not None:
+            self.backend.set(key, [version, value], ttl or self.ttl)
+        return value
+
+    def invalidate(self, keys):
+        self.backend.delete(keys)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "size": self.backend.size(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.backend.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None
+        }
@@ -0,0 +1,44 @@
+"""
+Conditional GET: strong ETags derived from the version counters of the tables a response reads
+"""
+import hashlib
+from functools import wraps
+from flask import request, make_response, Response
+from models import table_versions
+
+def include_tables(model):
+    # ?include= adds the tables of the included relationships; unknown names are rejected by the view
+    allowed = getattr(model, 'INCLUDES', {})
+    names = [name.strip() for name in request.args.get('include', '').split(',')]
+    return [getattr(model, allowed[name]).property.mapper.class_.__tablename__ for name in names if name in allowed]
+
+def compute_etag(tables):
+    versions = table_versions(list(tables))
+    # the same tables give different documents for different paths, query strings and media types
+    seed = "{}|{}|{}".format(
+        ",".join("{}={}".format(table, version) for table, version in zip(tables, versions)),
+        request.full_path,
+        request.headers.get("Accept", "")
+    )
+    return hashlib.sha1(seed.encode("utf-8")).hexdigest()
+
+def conditional(*tables, model=None):
+    # answers 304 before the view runs its query when the client already has the current version
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return view(*args, **kwargs)
+
+            etag = compute_etag(list(tables) + (include_tables(model) if model is not None else []))
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
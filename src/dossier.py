@@ -0,0 +1,65 @@
+"""
+A student's whole file (profile, agreements, installments, payments, invoices, credit notes and
+documents) assembled server side from indexed lookups
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from models import db, entity_cache, cache_key, table_versions, Profile, EnrrollmentAgreement, Financing, Installment, Payment, Invoice, CreditNote, JobProfile, Rut
+from utils import select_fields, row_serializer
+
+DOSSIER_TABLES = ['profiles', 'enrrollment_agreements', 'financing_agreements', 'installments', 'payments', 'invoices', 'credit_notes', 'job_profiles', 'ruts']
+DOSSIER_CACHE_TTL = int(os.environ.get('DOSSIER_CACHE_TTL', 30))
+DOSSIER_WORKERS = int(os.environ.get('DOSSIER_WORKERS', 4))
+
+# the lookups after the profile are independent, with workers they run on their own connections
+executor = ThreadPoolExecutor(max_workers=DOSSIER_WORKERS) if DOSSIER_WORKERS > 1 else None
+
+def section_statement(model, criterion, join=None):
+    query = select_fields(model.query, model, list(model.FIELDS))
+    if join is not None:
+        query = query.join(*join)
+    return query.filter(criterion).order_by(model.id).statement
+
+def fetch(engine, statement):
+    with engine.connect() as connection:
+        return connection.execute(statement).fetchall()
+
+def student_dossier(breathecode_id):
+    engine = db.engine
+    profile = fetch(engine, section_statement(Profile, Profile.breathecode_id == breathecode_id))
+    if not profile:
+        return None
+    profile = row_serializer(Profile, list(Profile.FIELDS))(profile[0])
+    rut = profile["rut"]
+
+    # (name, model, statement, many): every lookup is served by a unique or plain index
+    sections = [
+        ("enrrollment_agreement", EnrrollmentAgreement, section_statement(EnrrollmentAgreement, EnrrollmentAgreement.breathecode_id == breathecode_id), False),
+        ("financing_agreement", Financing, section_statement(Financing, Financing.rut == rut), False),
+        ("installments", Installment, section_statement(Installment, Financing.rut == rut, join=(Financing, Installment.financing_id == Financing.id)), True),
+        ("payments", Payment, section_statement(Payment, Payment.rut == rut), True),
+        ("invoices", Invoice, section_statement(Invoice, Invoice.rut == rut), True),
+        ("credit_notes", CreditNote, section_statement(CreditNote, CreditNote.rut == rut), True),
+        ("job_profile", JobProfile, section_statement(JobProfile, JobProfile.breathecode_id == breathecode_id), False),
+        ("rut_document", Rut, section_statement(Rut, Rut.rut_id == rut), False)
+    ]
+
+    if executor is not None:
+        futures = [executor.submit(fetch, engine, statement) for name, model, statement, many in sections]
+        results = [future.result() for future in futures]
+    else:
+        with engine.connect() as connection:
+            results = [connection.execute(statement).fetchall() for name, model, statement, many in sections]
+
+    dossier = {"profile": profile}
+    for (name, model, statement, many), rows in zip(sections, results):
+        items = list(map(row_serializer(model, list(model.FIELDS)), rows))
+        dossier[name] = items if many else (items[0] if items else None)
+    return dossier
+
+def cached_dossier(breathecode_id):
+    # the key carries the versions of every table the dossier reads, so any write to one of them,
+    # through the ORM or not, makes the next request build it again
+    versions = table_versions(DOSSIER_TABLES)
+    key = cache_key("Dossier", breathecode_id, ".".join(map(str, versions)))
+    return entity_cache.get_or_load(key, lambda: student_dossier(breathecode_id), ttl=DOSSIER_CACHE_TTL)
@@ -0,0 +1,70 @@
+"""
+Runs EXPLAIN on the query each collection filter produces and reports the indexes the plan reads
+"""
+import re
+from sqlalchemy import Boolean, Integer, DateTime
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from models import db, StaffUser, TeacherUser, StudentUser, Profile, Payment, Invoice, TeacherQuestion, StudentQuestion, TeacherAnswer
+from utils import select_fields, filter_criteria, DEFAULT_PAGE_SIZE
+
+FILTERED_MODELS = [StaffUser, TeacherUser, StudentUser, Profile, Payment, Invoice, TeacherQuestion, StudentQuestion, TeacherAnswer]
+
+# index names in postgresql and sqlite plans; mysql returns them in the key column instead
+PLAN_INDEX_PATTERNS = [
+    re.compile(r'Index (?:Only )?Scan (?:Backward )?using (\w+)'),
+    re.compile(r'Bitmap Index Scan on (\w+)'),
+    re.compile(r'USING (?:COVERING )?INDEX (\w+)')
+]
+
+class Explain(Executable, ClauseElement):
+
+    def __init__(self, statement):
+        self.statement = statement
+
+@compiles(Explain)
+def compile_explain(element, compiler, **kw):
+    prefix = "EXPLAIN QUERY PLAN " if compiler.dialect.name == 'sqlite' else "EXPLAIN "
+    return prefix + compiler.process(element.statement, **kw)
+
+def sample_args(param, column):
+    if isinstance(column.type, DateTime):
+        return {param + '_from': '2020-01-01', param + '_to': '2020-01-31'}
+    if isinstance(column.type, Boolean):
+        return {param: 'false'}
+    if isinstance(column.type, Integer):
+        return {param: '1'}
+    return {param: 'sample'}
+
+def plan_indexes(rows, dialect):
+    # the primary key does not count: a pk scan with a filter is a full scan in id order
+    if dialect == 'mysql':
+        names = [row['key'] for row in rows if row['key']]
+    else:
+        plan = "\n".join(str(row[-1]) for row in rows)
+        names = [name for pattern in PLAN_INDEX_PATTERNS for name in pattern.findall(plan)]
+    return [name for name in names if name != 'PRIMARY' and not name.endswith('_pkey')]
+
+def check_filter_indexes():
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        # a local database is small, so the planner would pick a sequential scan whatever the
+        # indexes; with it off the plan shows whether an index can answer the filter at all
+        db.session.execute("SET LOCAL enable_seqscan = off")
+
+    results = []
+    for model in FILTERED_MODELS:
+        for param, attr in model.FILTERS.items():
+            args = sample_args(param, model.__table__.c[attr])
+            # the same statement paginate() sends for the first page
+            query = select_fields(model.query, model, list(model.FIELDS)) \
+                .filter(*filter_criteria(model, args)).order_by(model.id).limit(DEFAULT_PAGE_SIZE + 1)
+            rows = db.session.execute(Explain(query.statement)).fetchall()
+            results.append({
+                "table": model.__tablename__,
+                "filter": param,
+                "indexes": plan_indexes(rows, dialect)
+            })
+
+    db.session.rollback()
+    return results
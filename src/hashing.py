@@ -0,0 +1,96 @@
+"""
+Password hashing with a bcrypt cost calibrated once per host. Hashes run inline on the request
+worker: bcrypt releases the GIL, and the gunicorn worker count (WEB_CONCURRENCY) already bounds
+how many run at once on the host
+"""
+import os
+import math
+import time
+import tempfile
+import bcrypt
+
+DEFAULT_LOG_ROUNDS = 12
+MIN_LOG_ROUNDS = 10
+MAX_LOG_ROUNDS = 15
+CALIBRATION_SAMPLES = 5
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def _check(hashed, password):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    except ValueError:
+        return False
+
+def hash_rounds(hashed):
+    # bcrypt hashes look like $2b$12$<salt+hash>
+    try:
+        return int(hashed.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+def calibrate_rounds(target_ms):
+    # median of several timings, a single one is easily thrown off by a busy CPU at boot
+    samples = []
+    for _ in range(CALIBRATION_SAMPLES):
+        start = time.perf_counter()
+        _hash('calibration', MIN_LOG_ROUNDS)
+        samples.append((time.perf_counter() - start) * 1000)
+    elapsed_ms = max(sorted(samples)[len(samples) // 2], 0.001)
+
+    # every extra round doubles the cost of a hash
+    extra = int(round(math.log2(max(target_ms / elapsed_ms, 1))))
+    return min(MIN_LOG_ROUNDS + extra, MAX_LOG_ROUNDS)
+
+def shared_rounds(target_ms, path):
+    # the first worker of the host calibrates and the rest read its result, so every worker
+    # hashes with the same cost instead of each one trusting its own timing
+    try:
+        with open(path) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        pass
+    rounds = calibrate_rounds(target_ms)
+    partial = "{}.{}".format(path, os.getpid())
+    with open(partial, 'w') as f:
+        f.write(str(rounds))
+    os.replace(partial, path)
+    return rounds
+
+class PasswordHasher:
+
+    def __init__(self, log_rounds=DEFAULT_LOG_ROUNDS):
+        self.log_rounds = log_rounds
+        # moving average of a verification, used to estimate the CPU saved by the login throttle
+        self.check_ms = None
+
+    @classmethod
+    def from_env(cls):
+        if os.environ.get('BCRYPT_LOG_ROUNDS'):
+            log_rounds = int(os.environ['BCRYPT_LOG_ROUNDS'])
+        elif os.environ.get('BCRYPT_TARGET_MS'):
+            target_ms = float(os.environ['BCRYPT_TARGET_MS'])
+            path = os.environ.get('BCRYPT_ROUNDS_PATH', os.path.join(tempfile.gettempdir(), 'bcrypt_rounds_{}ms'.format(int(target_ms))))
+            log_rounds = shared_rounds(target_ms, path)
+        else:
+            log_rounds = DEFAULT_LOG_ROUNDS
+        return cls(log_rounds)
+
+    def hash(self, password):
+        return _hash(password, self.log_rounds)
+
+    def hash_many(self, passwords):
+        return [_hash(password, self.log_rounds) for password in passwords]
+
+    def check(self, hashed, password):
+        start = time.perf_counter()
+        result = _check(hashed, password)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.check_ms = elapsed_ms if self.check_ms is None else self.check_ms * 0.9 + elapsed_ms * 0.1
+        return result
+
+    def needs_rehash(self, hashed):
+        # only upgrades: a hash stronger than this worker's cost is left alone
+        rounds = hash_rounds(hashed)
+        return rounds is None or rounds < self.log_rounds
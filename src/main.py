@@ -2,14 +2,27 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
-from flask import Flask, request, jsonify, url_for
+import io
+import csv
+import click
+from flask import Flask, request, jsonify, url_for, Response
+from itertools import chain
 from flask_migrate import Migrate
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_swagger import swagger
 from flask_cors import CORS
-from utils import APIException, generate_sitemap
+from utils import APIException, generate_sitemap, paginate, wants_stream, stream_ndjson, multi_get, shape_item, json_response, read_bulk_rows, iter_csv_chunks, parse_money
 from admin import setup_admin
-from models import db, Role, StaffUser, TeacherUser, StudentUser, Profile, EnrrollmentAgreement, Financing, Payment, Invoice, CreditNote, TeacherQuestionnarie, TeacherQuestion, StudentQuestionnarie, StudentQuestion, TeacherAnswer
-from flask_bcrypt import Bcrypt
+from hashing import PasswordHasher
+from throttle import LoginThrottle, client_ip
+from reports import cohort_financial_report, report_rows
+from reconciliation import reconcile
+from benchmark import serialization_benchmark, report_benchmark
+from dossier import cached_dossier, DOSSIER_TABLES
+from explain import check_filter_indexes
+from rut import normalize_rut, validate_ruts
+from conditional import conditional
+from models import db, email_key, track_table_versions, entity_cache, get_cached, find_account, serialize_account, ACCOUNT_MODELS, upsert_teacher_answers, rebuild_rollups, TeacherAnswerRollup, money, allocate_payment, Installment, Role, StaffUser, TeacherUser, StudentUser, Profile, EnrrollmentAgreement, Financing, Payment, Invoice, CreditNote, TeacherQuestionnarie, TeacherQuestion, StudentQuestionnarie, StudentQuestion, TeacherAnswer
 from flask_jwt_extended.jwt_manager import JWTManager
 from flask_jwt_extended.utils import create_access_token, get_jwt_identity
 from flask_jwt_extended.view_decorators import jwt_required
@@ -18,15 +31,29 @@ from datetime import timedelta
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
+# number of proxies in front of the app that append to X-Forwarded-For (1 behind the heroku router);
+# with 0 the header is ignored and the client is the peer address
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['JWT_SECRET_KEY'] = 'secret-key'
 MIGRATE = Migrate(app, db)
 db.init_app(app)
+with app.app_context():
+    track_table_versions(db.engine)
 CORS(app)
 setup_admin(app)
 jwt = JWTManager(app)
-bcrypt = Bcrypt(app)
+hasher = PasswordHasher.from_env()
+throttle = LoginThrottle.from_env()
+
+def rehash_password(model, id, hashed, password):
+    # the configured work factor changed since this hash was stored, upgrade it while we have the password
+    if hasher.needs_rehash(hashed):
+        model.query.filter_by(id=id).update({"password": hasher.hash(password)})
+        db.session.commit()
 
 # Handle/serialize errors like a JSON object
 @app.errorhandler(APIException)
@@ -51,17 +78,20 @@ def create_role():
 
 @app.route('/student_users', methods=['GET','POST'])
 @app.route('/student_users/<int:id>', methods=['GET', 'PUT', 'DELETE'])
+@conditional('student_users', 'roles')
 def student_users(id = None):
     if request.method == 'GET':
         if id is not None:
-            student = StudentUser.query.get(id) # None por defecto si no consigue el registro
+            student = get_cached(StudentUser, "id", id) # None por defecto si no consigue el registro
             if student:
-                return jsonify(student.serialize()), 200
+                return jsonify(shape_item(student, StudentUser)), 200
             return jsonify({"msg": "User not found"}), 404
         else:
-            student = StudentUser.query.all()
-            student = list(map(lambda student: student.serialize(), student))
-            return jsonify(student), 200
+            found = multi_get(StudentUser.query, StudentUser)
+            if found is not None:
+                return json_response(found), 200
+            student = paginate(StudentUser.query, StudentUser)
+            return json_response(student), 200
     
     if request.method == 'POST':
 
@@ -81,7 +111,7 @@ def student_users(id = None):
         student.name = request.json.get("name", "")
         student.lastName = request.json.get("lastName", "")
         student.email = email
-        student.password = bcrypt.generate_password_hash(password).decode("utf-8")
+        student.password = hasher.hash(password)
         student.role_id = "2"
 
         student.save()
@@ -91,24 +121,83 @@ def student_users(id = None):
     if request.method == 'DELETE':
 
         deleteUser = StudentUser.query.filter_by(id=id).first()
-        db.session.delete(deleteUser)
-        db.session.commit()
+        deleteUser.delete()
         
         return jsonify({"msg": "User delete successfully"}), 200
 
+@app.route('/student_users/bulk', methods=['POST'])
+def student_users_bulk():
+    rows = read_bulk_rows()
+    results = []
+    valid = []
+
+    for index, row in enumerate(rows):
+        email = row.get("email") or ""
+        password = row.get("password") or ""
+        if not isinstance(email, str):
+            results.append({"row": index, "email": None, "status": "error", "msg": "Email must be a string"})
+            continue
+        email = email.strip()
+        result = {"row": index, "email": email}
+        results.append(result)
+
+        if not email:
+            result.update(status="error", msg="Email is required")
+        elif not isinstance(password, str):
+            result.update(status="error", msg="Password must be a string")
+        elif not password:
+            result.update(status="error", msg="Password is required")
+        else:
+            valid.append((row, result))
+
+    # one IN query for the whole batch on the case-insensitive email index, plus duplicates inside the batch itself
+    emails = [result["email"].lower() for row, result in valid]
+    existing = set()
+    if emails:
+        existing = {email.lower() for (email,) in db.session.query(StudentUser.email).filter(email_key(StudentUser.email).in_(emails))}
+
+    to_create = []
+    for row, result in valid:
+        email = result["email"].lower()
+        if email in existing:
+            result.update(status="error", msg="Email already exists")
+        else:
+            existing.add(email)
+            to_create.append((row, result))
+
+    passwords = hasher.hash_many([row["password"] for row, result in to_create])
+
+    db.session.bulk_insert_mappings(StudentUser, [{
+        "name": row.get("name") or "",
+        "lastName": row.get("lastName") or "",
+        "email": result["email"],
+        "password": password,
+        "role_id": 2
+    } for (row, result), password in zip(to_create, passwords)])
+    db.session.commit()
+
+    for row, result in to_create:
+        result["status"] = "created"
+
+    created = len(to_create)
+    return jsonify({"created": created, "failed": len(results) - created, "results": results}), 200
+
 @app.route('/staff_users', methods=['GET','POST'])
 @app.route('/staff_users/<int:id>', methods=['GET', 'PUT', 'DELETE'])
+@conditional('staff_users', 'roles')
 def staff_users(id = None):
     if request.method == 'GET':
         if id is not None:
-            staff = StaffUser.query.get(id) # None por defecto si no consigue el registro
+            staff = get_cached(StaffUser, "id", id) # None por defecto si no consigue el registro
             if staff:
-                return jsonify(staff.serialize()), 200
+                return jsonify(shape_item(staff, StaffUser)), 200
             return jsonify({"msg": "User not found"}), 404
         else:
-            staff = StaffUser.query.all()
-            staff = list(map(lambda staff: staff.serialize(), staff))
-            return jsonify(staff), 200
+            found = multi_get(StaffUser.query, StaffUser)
+            if found is not None:
+                return json_response(found), 200
+            staff = paginate(StaffUser.query, StaffUser)
+            return json_response(staff), 200
     
     if request.method == 'POST':
 
@@ -128,7 +217,7 @@ def staff_users(id = None):
         staff.name = request.json.get("name", "")
         staff.lastName = request.json.get("lastName", "")
         staff.email = email
-        staff.password = bcrypt.generate_password_hash(password).decode("utf-8")
+        staff.password = hasher.hash(password)
         staff.role_id = "1"
 
         staff.save()
@@ -147,32 +236,34 @@ def staff_users(id = None):
         if lastName !='':
             editUser.description = lastName
 
-        db.session.commit()
+        editUser.update()
 
         return jsonify({"msg": "User Updated"})  
 
     if request.method == 'DELETE':
 
         deleteUser = StaffUser.query.filter_by(id=id).first()
-        db.session.delete(deleteUser)
-        db.session.commit()
+        deleteUser.delete()
         
         return jsonify({"msg": "User delete successfully"}), 200
 
 
 @app.route('/teacher_users', methods=['GET','POST'])
 @app.route('/teacher_users/<int:id>', methods=['GET', 'PUT', 'DELETE'])
+@conditional('teacher_users', 'roles')
 def teacher_users(id = None):
     if request.method == 'GET':
         if id is not None:
-            teacher = TeacherUser.query.get(id) # None por defecto si no consigue el registro
+            teacher = get_cached(TeacherUser, "id", id) # None por defecto si no consigue el registro
             if teacher:
-                return jsonify(teacher.serialize()), 200
+                return jsonify(shape_item(teacher, TeacherUser)), 200
             return jsonify({"msg": "User not found"}), 404
         else:
-            teacher = TeacherUser.query.all()
-            teacher = list(map(lambda teacher: teacher.serialize(), teacher))
-            return jsonify(teacher), 200
+            found = multi_get(TeacherUser.query, TeacherUser)
+            if found is not None:
+                return json_response(found), 200
+            teacher = paginate(TeacherUser.query, TeacherUser)
+            return json_response(teacher), 200
     
     if request.method == 'POST':
 
@@ -192,7 +283,7 @@ def teacher_users(id = None):
         teacher.name = request.json.get("name", "")
         teacher.lastName = request.json.get("lastName", "")
         teacher.email = email
-        teacher.password = bcrypt.generate_password_hash(password).decode("utf-8")
+        teacher.password = hasher.hash(password)
         teacher.role_id = "3"
 
         teacher.save()
@@ -202,8 +293,7 @@ def teacher_users(id = None):
     if request.method == 'DELETE':
 
         deleteUser = TeacherUser.query.filter_by(id=id).first()
-        db.session.delete(deleteUser)
-        db.session.commit()
+        deleteUser.delete()
         
         return jsonify({"msg": "User delete successfully"}), 200
 
@@ -216,14 +306,21 @@ def student_login():
         return jsonify({"msg": "Email is required"}), 400
     if not password:
         return jsonify({"msg": "Password is required"}), 400
+    if not isinstance(email, str) or not isinstance(password, str):
+        return jsonify({"msg": "Email and password must be strings"}), 400
+
+    if not throttle.allow(email, client_ip(request)):
+        return jsonify({"msg": "Too many login attempts, try again later"}), 429
 
     student = StudentUser.query.filter_by(email=email).first()
     if not student:
         return jsonify({"msg": "Email/password incorrect"}), 400
     
-    if not bcrypt.check_password_hash(student.password, password):
+    if not hasher.check(student.password, password):
         return jsonify({"msg": "Email/password incorrect"}), 400
 
+    rehash_password(StudentUser, student.id, student.password, password)
+
     expires = timedelta(days=3)
     
     data = {
@@ -242,14 +339,21 @@ def staff_login():
         return jsonify({"msg": "Email is required"}), 400
     if not password:
         return jsonify({"msg": "Password is required"}), 400
+    if not isinstance(email, str) or not isinstance(password, str):
+        return jsonify({"msg": "Email and password must be strings"}), 400
+
+    if not throttle.allow(email, client_ip(request)):
+        return jsonify({"msg": "Too many login attempts, try again later"}), 429
 
     staff = StaffUser.query.filter_by(email=email).first()
     if not staff:
         return jsonify({"msg": "Email/password incorrect"}), 400
     
-    if not bcrypt.check_password_hash(staff.password, password):
+    if not hasher.check(staff.password, password):
         return jsonify({"msg": "Email/password incorrect"}), 400
 
+    rehash_password(StaffUser, staff.id, staff.password, password)
+
     expires = timedelta(days=3)
     
     data = {
@@ -269,14 +373,21 @@ def teacher_login():
         return jsonify({"msg": "Email is required"}), 400
     if not password:
         return jsonify({"msg": "Password is required"}), 400
+    if not isinstance(email, str) or not isinstance(password, str):
+        return jsonify({"msg": "Email and password must be strings"}), 400
+
+    if not throttle.allow(email, client_ip(request)):
+        return jsonify({"msg": "Too many login attempts, try again later"}), 429
 
     teacher = TeacherUser.query.filter_by(email=email).first()
     if not teacher:
         return jsonify({"msg": "Email/password incorrect"}), 400
     
-    if not bcrypt.check_password_hash(teacher.password, password):
+    if not hasher.check(teacher.password, password):
         return jsonify({"msg": "Email/password incorrect"}), 400
 
+    rehash_password(TeacherUser, teacher.id, teacher.password, password)
+
     expires = timedelta(days=3)
     
     data = {
@@ -285,21 +396,72 @@ def teacher_login():
     }
    
     return jsonify({"success": "Log In Successfully", "data": data}), 200
+@app.route('/login', methods=['POST'])
+def login():
+    email = request.json.get("email", None)
+    password = request.json.get("password", None)
 
+    if not email:
+        return jsonify({"msg": "Email is required"}), 400
+    if not password:
+        return jsonify({"msg": "Password is required"}), 400
+    if not isinstance(email, str) or not isinstance(password, str):
+        return jsonify({"msg": "Email and password must be strings"}), 400
+
+    if not throttle.allow(email, client_ip(request)):
+        return jsonify({"msg": "Too many login attempts, try again later"}), 429
+
+    account = find_account(email)
+    if not account:
+        return jsonify({"msg": "Email/password incorrect"}), 400
+
+    if not hasher.check(account.password, password):
+        return jsonify({"msg": "Email/password incorrect"}), 400
+
+    rehash_password(dict(ACCOUNT_MODELS)[account.kind], account.id, account.password, password)
+
+    expires = timedelta(days=3)
+
+    data = {
+        "access_token": create_access_token(identity=account.email, expires_delta=expires),
+        "account_type": account.kind,
+        account.kind: serialize_account(account)
+    }
+
+    return jsonify({"success": "Log In Successfully", "data": data}), 200
+
+
+@app.route('/login_throttle', methods=['GET'])
+@jwt_required
+def login_throttle():
+    stats = throttle.stats()
+    check_ms = hasher.check_ms or 0
+    stats["estimated_cpu_ms_saved"] = round(stats["rejected"] * check_ms)
+    return jsonify(stats), 200
+
+@app.route('/cache_stats', methods=['GET'])
+@jwt_required
+def cache_stats():
+    return jsonify(entity_cache.stats()), 200
 
 @app.route('/profiles', methods=['GET', 'POST'])
 @app.route('/profiles/<int:id>', methods=['GET', 'PUT', 'DELETE'])
+@conditional('profiles', model=Profile)
 def profiles(id = None):
     if request.method == 'GET':
         if id is not None:
-            profile = Profile.query.get(id) # None por defecto si no consigue el registro
+            profile = get_cached(Profile, "id", id) # None por defecto si no consigue el registro
             if profile:
-                return jsonify(profile.serialize()), 200
+                return jsonify(shape_item(profile, Profile)), 200
             return jsonify({"msg": "Profile not found"}), 404
         else:
-            profile = Profile.query.all()
-            profile = list(map(lambda profile: profile.serialize(), profile))
-            return jsonify(profile), 200
+            found = multi_get(Profile.query, Profile)
+            if found is not None:
+                return json_response(found), 200
+            if wants_stream():
+                return stream_ndjson(Profile.query, Profile)
+            profile = paginate(Profile.query, Profile)
+            return json_response(profile), 200
 
     if request.method == 'POST':
 
@@ -327,6 +489,9 @@ def profiles(id = None):
             return jsonify({"msg": "Size is required"}), 400
         if not rut:
             return jsonify({"msg": "Rut is required"}), 400
+        rut = normalize_rut(rut)
+        if not rut:
+            return jsonify({"msg": "RUT is not valid"}), 400
         if not cohort:
             return jsonify({"msg": "Cohort is required"}), 400
         if not name:
@@ -356,19 +521,124 @@ def profiles(id = None):
 
         return jsonify({"success": "Profile Register Successfully"}), 200
 
+PROFILE_REQUIRED_FIELDS = [
+    ("student_id", "Student ID is required"),
+    ("breathecode_id", "Breathecode ID is required"),
+    ("address", "Address is required"),
+    ("phone", "Phone is required"),
+    ("size", "Size is required"),
+    ("rut", "Rut is required"),
+    ("cohort", "Cohort is required"),
+    ("name", "Name is required"),
+    ("lastName", "Last Name is required"),
+    ("email", "Email is required")
+]
+MAX_REPORTED_ERRORS = 1000
+
+def validate_profile_chunk(rows, first_row):
+    errors = []
+    candidates = []
+
+    for offset, row in enumerate(rows):
+        index = first_row + offset
+        profile = {field: (row.get(field) or "").strip() for field, msg in PROFILE_REQUIRED_FIELDS}
+        missing = [msg for field, msg in PROFILE_REQUIRED_FIELDS if not profile[field]]
+        if missing:
+            errors.append({"row": index, "msg": missing[0]})
+            continue
+        try:
+            profile["student_id"] = int(profile["student_id"])
+            profile["breathecode_id"] = int(profile["breathecode_id"])
+        except ValueError:
+            errors.append({"row": index, "msg": "Student ID and Breathecode ID must be numbers"})
+            continue
+        candidates.append((index, profile))
+
+    ruts, invalid = validate_ruts([profile["rut"] for index, profile in candidates])
+    for (index, profile), rut in zip(candidates, ruts):
+        profile["rut"] = rut
+    for position in invalid:
+        errors.append({"row": candidates[position][0], "msg": "RUT is not valid"})
+    candidates = [candidate for candidate in candidates if candidate[1]["rut"] is not None]
+
+    if not candidates:
+        return [], errors
+
+    # one query for every unique key of the chunk and one for the referenced students;
+    # rows from earlier chunks are already committed, so they are caught here too
+    ruts = {profile["rut"] for index, profile in candidates}
+    emails = {profile["email"] for index, profile in candidates}
+    breathecode_ids = {profile["breathecode_id"] for index, profile in candidates}
+    student_ids = {profile["student_id"] for index, profile in candidates}
+
+    taken = {"rut": set(), "email": set(), "breathecode_id": set(), "student_id": set()}
+    conflicts = db.session.query(Profile.rut, Profile.email, Profile.breathecode_id, Profile.student_id).filter(db.or_(
+        Profile.rut.in_(ruts),
+        Profile.email.in_(emails),
+        Profile.breathecode_id.in_(breathecode_ids),
+        Profile.student_id.in_(student_ids)
+    ))
+    for rut, email, breathecode_id, student_id in conflicts:
+        taken["rut"].add(rut)
+        taken["email"].add(email)
+        taken["breathecode_id"].add(breathecode_id)
+        taken["student_id"].add(student_id)
+
+    students = {student_id for (student_id,) in db.session.query(StudentUser.id).filter(StudentUser.id.in_(student_ids))}
+
+    valid = []
+    for index, profile in candidates:
+        if profile["student_id"] not in students:
+            errors.append({"row": index, "msg": "Student not found"})
+            continue
+        duplicated = [key for key in taken if profile[key] in taken[key]]
+        if duplicated:
+            msg = "Profile already exists" if duplicated[0] == "student_id" else "Duplicated {}".format(duplicated[0])
+            errors.append({"row": index, "msg": msg})
+            continue
+        for key in taken:
+            taken[key].add(profile[key])
+        valid.append(profile)
+
+    return valid, errors
+
+@app.route('/profiles/import', methods=['POST'])
+def profiles_import():
+    imported = 0
+    failed = 0
+    errors = []
+    first_row = 0
+
+    for rows in iter_csv_chunks():
+        valid, chunk_errors = validate_profile_chunk(rows, first_row)
+        first_row += len(rows)
+
+        if valid:
+            db.session.bulk_insert_mappings(Profile, valid)
+            db.session.commit()
+
+        imported += len(valid)
+        failed += len(chunk_errors)
+        errors.extend(chunk_errors[:MAX_REPORTED_ERRORS - len(errors)])
+
+    return jsonify({"imported": imported, "failed": failed, "errors": errors}), 200
+
 @app.route('/enrrollment_agreements', methods=['GET'])
 @app.route('/enrrollment_agreements/<int:breathecode_id>', methods=['GET', 'PUT', 'DELETE', 'POST'])
+@conditional('enrrollment_agreements')
 def enrrollment_agreements(breathecode_id = None):
     if request.method == 'GET':
         if breathecode_id is not None:
-            agreement = EnrrollmentAgreement.query.filter_by(breathecode_id=breathecode_id).first() # None por defecto si no consigue el registro
+            agreement = get_cached(EnrrollmentAgreement, "breathecode_id", breathecode_id) # None por defecto si no consigue el registro
             if agreement:
-                return jsonify(agreement.serialize()), 200
+                return jsonify(shape_item(agreement, EnrrollmentAgreement)), 200
             return jsonify({"msg": "Enrrollment Agreement not found"}), 404
         else:
-            agreement = EnrrollmentAgreement.query.all()
-            agreement = list(map(lambda agreement: agreement.serialize(), agreement))
-            return jsonify(agreement), 200
+            found = multi_get(EnrrollmentAgreement.query, EnrrollmentAgreement)
+            if found is not None:
+                return json_response(found), 200
+            agreement = paginate(EnrrollmentAgreement.query, EnrrollmentAgreement)
+            return json_response(agreement), 200
 
     if request.method == 'POST':
 
@@ -396,18 +666,21 @@ def enrrollment_agreements(breathecode_id = None):
 
 @app.route('/financing_agreements', methods=['GET', 'POST'])
 @app.route('/financing_agreements/<string:rut>', methods=['GET', 'PUT', 'DELETE'])
+@conditional('financing_agreements')
 def financing_agreements(rut = None):
     if request.method == 'GET':
         if rut is not None:
-            financing = Financing.query.filter_by(rut=rut).first() # None por defecto si no consigue el registro
-            print(rut)
+            rut = normalize_rut(rut)
+            financing = get_cached(Financing, "rut", rut) if rut else None # None por defecto si no consigue el registro
             if financing:
-                return jsonify(financing.serialize()), 200
+                return jsonify(shape_item(financing, Financing)), 200
             return jsonify({"msg": "Financing Agreement not found"}), 404
         else:
-            financing = Financing.query.all()
-            financing = list(map(lambda financing: financing.serialize(), financing))
-            return jsonify(financing), 200
+            found = multi_get(Financing.query, Financing)
+            if found is not None:
+                return json_response(found), 200
+            financing = paginate(Financing.query, Financing)
+            return json_response(financing), 200
 
     if request.method == 'POST':
 
@@ -423,8 +696,14 @@ def financing_agreements(rut = None):
             return jsonify({"msg": "Month is required"}), 400
         if not monthlyFee:
             return jsonify({"msg": "Monthly Fee is required"}), 400
+        monthlyFee = parse_money(monthlyFee)
+        if monthlyFee is None:
+            return jsonify({"msg": "Monthly Fee must be a number"}), 400
         if not rut:
             return jsonify({"msg": "RUT is required"}), 400
+        rut = normalize_rut(rut)
+        if not rut:
+            return jsonify({"msg": "RUT is not valid"}), 400
         
 
         financing = Financing.query.filter_by(rut=rut).first()
@@ -436,24 +715,53 @@ def financing_agreements(rut = None):
         financing.months = months
         financing.monthlyFee = monthlyFee
         financing.rut = rut
+        financing.installments = financing.schedule()
 
         financing.save()
 
         return jsonify({"success": "Financing Agreement Register Successfully"}), 200
 
+@app.route('/financing_agreements/overdue', methods=['GET'])
+@jwt_required
+def overdue_financing_agreements():
+    today = datetime.utcnow().date()
+
+    # served by ix_installments_status_due_date, only late installments are read
+    overdue = db.session.query(
+        Financing.rut,
+        db.func.count(Installment.id),
+        db.func.sum(Installment.amount - Installment.paid_amount),
+        db.func.min(Installment.due_date)
+    ).join(Financing, Financing.id == Installment.financing_id) \
+        .filter(Installment.status == "pending", Installment.due_date < today) \
+        .group_by(Financing.rut) \
+        .order_by(db.func.min(Installment.due_date))
+
+    return jsonify([{
+        "rut": rut,
+        "overdue_installments": count,
+        "overdue_amount": money(amount),
+        "oldest_due_date": oldest.isoformat() if hasattr(oldest, "isoformat") else oldest
+    } for rut, count, amount, oldest in overdue]), 200
+
 @app.route('/payments', methods=['GET', 'POST'])
 @app.route('/payments/<int:id>', methods=['GET', 'PUT', 'DELETE'])
+@conditional('payments')
 def payments(id = None):
     if request.method == 'GET':
         if id is not None:
-            payment = Payment.query.get(id) # None por defecto si no consigue el registro
+            payment = get_cached(Payment, "id", id) # None por defecto si no consigue el registro
             if payment:
-                return jsonify(payment.serialize()), 200
+                return jsonify(shape_item(payment, Payment)), 200
             return jsonify({"msg": "Financing Agreement not found"}), 404
         else:
-            payment = Payment.query.all()
-            payment = list(map(lambda payment: payment.serialize(), payment))
-            return jsonify(payment), 200
+            found = multi_get(Payment.query, Payment)
+            if found is not None:
+                return json_response(found), 200
+            if wants_stream():
+                return stream_ndjson(Payment.query, Payment)
+            payment = paginate(Payment.query, Payment)
+            return json_response(payment), 200
 
     if request.method == 'POST':
 
@@ -468,12 +776,18 @@ def payments(id = None):
             return jsonify({"msg": "URL is required"}), 400
         if not amount:
             return jsonify({"msg": "Amount is required"}), 400
+        amount = parse_money(amount)
+        if amount is None:
+            return jsonify({"msg": "Amount must be a number"}), 400
         if not bank:
             return jsonify({"msg": "Bank is required"}), 400
         if not payment_method:
             return jsonify({"msg": "Payment Method is required"}), 400
         if not rut:
             return jsonify({"msg": "RUT is required"}), 400
+        rut = normalize_rut(rut)
+        if not rut:
+            return jsonify({"msg": "RUT is not valid"}), 400
         
 
         payment = Payment.query.filter_by(id=id).first()
@@ -487,23 +801,41 @@ def payments(id = None):
         payment.payment_method = payment_method
         payment.rut = rut
 
-        payment.save()
+        db.session.add(payment)
+        db.session.flush()
+        settled = allocate_payment(payment)
+        db.session.commit()
 
-        return jsonify({"success": "Payment Register Successfully"}), 200
+        return jsonify({"success": "Payment Register Successfully", "settled_installments": len(settled)}), 200
+
+@app.route('/payments/reconcile', methods=['POST'])
+@jwt_required
+def payments_reconcile():
+    tolerance_days = request.args.get("tolerance_days", 3, type=int)
+    if tolerance_days < 0:
+        return jsonify({"msg": "tolerance_days can not be negative"}), 400
+
+    result = reconcile(chain.from_iterable(iter_csv_chunks()), tolerance_days)
+    return jsonify(result), 200
 
 @app.route('/invoices', methods=['GET', 'POST'])
 @app.route('/invoices/<int:id>', methods=['GET', 'PUT', 'DELETE'])
+@conditional('invoices')
 def invoices(id = None):
     if request.method == 'GET':
         if id is not None:
-            invoice = Invoice.query.get(id) # None por defecto si no consigue el registro
+            invoice = get_cached(Invoice, "id", id) # None por defecto si no consigue el registro
             if invoice:
-                return jsonify(invoice.serialize()), 200
+                return jsonify(shape_item(invoice, Invoice)), 200
             return jsonify({"msg": "Invoice not found"}), 404
         else:
-            invoice = Invoice.query.all()
-            invoice = list(map(lambda invoice: invoice.serialize(), invoice))
-            return jsonify(invoice), 200
+            found = multi_get(Invoice.query, Invoice)
+            if found is not None:
+                return json_response(found), 200
+            if wants_stream():
+                return stream_ndjson(Invoice.query, Invoice)
+            invoice = paginate(Invoice.query, Invoice)
+            return json_response(invoice), 200
 
     if request.method == 'POST':
 
@@ -519,8 +851,14 @@ def invoices(id = None):
             return jsonify({"msg": "Date is required"}), 400
         if not amount:
             return jsonify({"msg": "Amount is required"}), 400
+        amount = parse_money(amount)
+        if amount is None:
+            return jsonify({"msg": "Amount must be a number"}), 400
         if not rut:
             return jsonify({"msg": "RUT is required"}), 400
+        rut = normalize_rut(rut)
+        if not rut:
+            return jsonify({"msg": "RUT is not valid"}), 400
         
 
         invoice = Invoice.query.filter_by(id=id).first()
@@ -539,17 +877,22 @@ def invoices(id = None):
 
 @app.route('/credit_notes', methods=['GET', 'POST'])
 @app.route('/credit_notes/<int:id>', methods=['GET', 'PUT', 'DELETE'])
+@conditional('credit_notes')
 def credit_notes(id = None):
     if request.method == 'GET':
         if id is not None:
-            credit_note = CreditNote.query.get(id) # None por defecto si no consigue el registro
+            credit_note = get_cached(CreditNote, "id", id) # None por defecto si no consigue el registro
             if credit_note:
-                return jsonify(credit_note.serialize()), 200
+                return jsonify(shape_item(credit_note, CreditNote)), 200
             return jsonify({"msg": "Credit Note not found"}), 404
         else:
-            credit_note = CreditNote.query.all()
-            credit_note = list(map(lambda credit_note: credit_note.serialize(), credit_note))
-            return jsonify(credit_note), 200
+            found = multi_get(CreditNote.query, CreditNote)
+            if found is not None:
+                return json_response(found), 200
+            if wants_stream():
+                return stream_ndjson(CreditNote.query, CreditNote)
+            credit_note = paginate(CreditNote.query, CreditNote)
+            return json_response(credit_note), 200
 
     if request.method == 'POST':
 
@@ -565,8 +908,14 @@ def credit_notes(id = None):
             return jsonify({"msg": "Date is required"}), 400
         if not amount:
             return jsonify({"msg": "Amount is required"}), 400
+        amount = parse_money(amount)
+        if amount is None:
+            return jsonify({"msg": "Amount must be a number"}), 400
         if not rut:
             return jsonify({"msg": "RUT is required"}), 400
+        rut = normalize_rut(rut)
+        if not rut:
+            return jsonify({"msg": "RUT is not valid"}), 400
         
 
         credit_note = CreditNote.query.filter_by(id=id).first()
@@ -583,20 +932,38 @@ def credit_notes(id = None):
 
         return jsonify({"success": "Credit Note Register Successfully"}), 200        
 
+def read_nested_questions():
+    # optional ordered list of questions, as strings or {"question": "..."} objects
+    questions = request.json.get("questions", None) or []
+    if not isinstance(questions, list):
+        return None, "Questions must be a list"
+
+    result = []
+    for question in questions:
+        if isinstance(question, dict):
+            question = question.get("question", None)
+        if not question or not isinstance(question, str):
+            return None, "Question is required"
+        result.append(question)
+    return result, None
+
 @app.route('/teacher_questionnaries', methods=['GET', 'POST'])
 @app.route('/teacher_questionnaries/<int:id>', methods=['GET', 'PUT', 'DELETE'])
 @jwt_required
+@conditional('teacher_questionnaries', model=TeacherQuestionnarie)
 def teacher_questionnaries(id = None):
     if request.method == 'GET':
         if id is not None:
-            questionnarie = TeacherQuestionnarie.query.get(id) # None por defecto si no consigue el registro
+            questionnarie = get_cached(TeacherQuestionnarie, "id", id) # None por defecto si no consigue el registro
             if questionnarie:
-                return jsonify(questionnarie.serialize()), 200
+                return jsonify(shape_item(questionnarie, TeacherQuestionnarie)), 200
             return jsonify({"msg": "Questionarie not found"}), 404
         else:
-            questionnarie = TeacherQuestionnarie.query.all()
-            questionnarie = list(map(lambda questionnarie: questionnarie.serialize(), questionnarie))
-            return jsonify(questionnarie), 200
+            found = multi_get(TeacherQuestionnarie.query, TeacherQuestionnarie)
+            if found is not None:
+                return json_response(found), 200
+            questionnarie = paginate(TeacherQuestionnarie.query, TeacherQuestionnarie)
+            return json_response(questionnarie), 200
 
     if request.method == 'POST':
 
@@ -611,26 +978,29 @@ def teacher_questionnaries(id = None):
         if not name:
             return jsonify({"msg": "Name is required"}), 400
 
-        questionnarie = TeacherQuestionnarie.query.filter_by(id=id).first()
-        if questionnarie:
-            return jsonify({"msg": "Questionnarie already exists"}), 400
-        
+        questions, error = read_nested_questions()
+        if error:
+            return jsonify({"msg": error}), 400
+
         questionnarie = TeacherQuestionnarie()
         questionnarie.questionnarie_details = questionnarie_details
         questionnarie.name = name
         questionnarie.staff_user = staff_user.id
 
-        questionnarie.save()
+        # questionnarie and questions go in together: flush for the id, bulk insert, one commit
+        db.session.add(questionnarie)
+        db.session.flush()
+        db.session.bulk_insert_mappings(TeacherQuestion, [{"questionnarie_id": questionnarie.id, "question": question} for question in questions])
+        db.session.commit()
 
-        return jsonify({"success": "Questionnarie Register Successfully"}), 200
+        return jsonify({"success": "Questionnarie Register Successfully", "id": questionnarie.id, "questions": len(questions)}), 200
 
 
     if request.method == 'DELETE':
 
         delete_questionnarie = TeacherQuestionnarie.query.filter_by(id=id).first()
         print(delete_questionnarie)
-        db.session.delete(delete_questionnarie)
-        db.session.commit()
+        delete_questionnarie.delete()
 
         return jsonify({"msg": "Questionnarie deleted"}), 200
     
@@ -648,7 +1018,7 @@ def teacher_questionnaries(id = None):
         if name != '':
             update_questionnarie.name = name
 
-        db.session.commit()
+        update_questionnarie.update()
 
         return ({'msg': 'Questionnarie Updated'})  
 
@@ -656,17 +1026,20 @@ def teacher_questionnaries(id = None):
 @app.route('/teacher_questions', methods=['GET', 'POST'])
 @app.route('/teacher_questions/<int:id>', methods=['GET', 'PUT', 'DELETE'])
 @jwt_required
+@conditional('teacher_questions')
 def teacher_question(id = None):
     if request.method == 'GET':
         if id is not None:
-            teacher_question = TeacherQuestion.query.get(id) # None por defecto si no consigue el registro
+            teacher_question = get_cached(TeacherQuestion, "id", id) # None por defecto si no consigue el registro
             if teacher_question:
-                return jsonify(teacher_question.serialize()), 200
+                return jsonify(shape_item(teacher_question, TeacherQuestion)), 200
             return jsonify({"msg": "Teacher Question not found"}), 404
         else:
-            teacher_question = TeacherQuestion.query.all()
-            teacher_question = list(map(lambda teacher_question: teacher_question.serialize(), teacher_question))
-            return jsonify(teacher_question), 200
+            found = multi_get(TeacherQuestion.query, TeacherQuestion)
+            if found is not None:
+                return json_response(found), 200
+            teacher_question = paginate(TeacherQuestion.query, TeacherQuestion)
+            return json_response(teacher_question), 200
 
     if request.method == 'POST':
 
@@ -675,10 +1048,6 @@ def teacher_question(id = None):
         if not question:
             return jsonify({"msg": "Question is required"}), 400
         
-        teacher_question = TeacherQuestion.query.filter_by(id=id).first()
-        if teacher_question:
-            return jsonify({"msg": "Question already exists"}), 400
-        
         teacher_question = TeacherQuestion()
         teacher_question.question = question
         teacher_question.questionnarie_id = request.json.get("questionnarie_id", None)
@@ -690,8 +1059,7 @@ def teacher_question(id = None):
     if request.method == 'DELETE':
 
         delete_question = TeacherQuestion.query.filter_by(id=id).first()
-        db.session.delete(delete_question)
-        db.session.commit()
+        delete_question.delete()
 
         return jsonify({"msg": "Question deleted"}), 200
     
@@ -704,7 +1072,7 @@ def teacher_question(id = None):
         if question != '':
             update_question.question = question
     
-        db.session.commit()
+        update_question.update()
 
         return ({'msg': 'Question Updated'})  
 
@@ -712,17 +1080,20 @@ def teacher_question(id = None):
 @app.route('/student_questionnaries', methods=['GET', 'POST'])
 @app.route('/student_questionnaries/<int:id>', methods=['GET', 'PUT', 'DELETE'])
 @jwt_required
+@conditional('student_questionnaries', model=StudentQuestionnarie)
 def student_questionnaries(id = None):
     if request.method == 'GET':
         if id is not None:
-            questionnarie = StudentQuestionnarie.query.get(id) # None por defecto si no consigue el registro
+            questionnarie = get_cached(StudentQuestionnarie, "id", id) # None por defecto si no consigue el registro
             if questionnarie:
-                return jsonify(questionnarie.serialize()), 200
+                return jsonify(shape_item(questionnarie, StudentQuestionnarie)), 200
             return jsonify({"msg": "Questionarie not found"}), 404
         else:
-            questionnarie = StudentQuestionnarie.query.all()
-            questionnarie = list(map(lambda questionnarie: questionnarie.serialize(), questionnarie))
-            return jsonify(questionnarie), 200
+            found = multi_get(StudentQuestionnarie.query, StudentQuestionnarie)
+            if found is not None:
+                return json_response(found), 200
+            questionnarie = paginate(StudentQuestionnarie.query, StudentQuestionnarie)
+            return json_response(questionnarie), 200
 
     if request.method == 'POST':
 
@@ -737,25 +1108,28 @@ def student_questionnaries(id = None):
         if not name:
             return jsonify({"msg": "Name is required"}), 400
 
-        questionnarie = StudentQuestionnarie.query.filter_by(id=id).first()
-        if questionnarie:
-            return jsonify({"msg": "Questionnarie already exists"}), 400
-        
+        questions, error = read_nested_questions()
+        if error:
+            return jsonify({"msg": error}), 400
+
         questionnarie = StudentQuestionnarie()
         questionnarie.questionnarie_details = questionnarie_details
         questionnarie.name = name
         questionnarie.staff_user = staff_user.id
 
-        questionnarie.save()
+        # questionnarie and questions go in together: flush for the id, bulk insert, one commit
+        db.session.add(questionnarie)
+        db.session.flush()
+        db.session.bulk_insert_mappings(StudentQuestion, [{"questionnarie_id": questionnarie.id, "question": question} for question in questions])
+        db.session.commit()
 
-        return jsonify({"success": "Questionnarie Register Successfully"}), 200
+        return jsonify({"success": "Questionnarie Register Successfully", "id": questionnarie.id, "questions": len(questions)}), 200
 
 
     if request.method == 'DELETE':
 
         delete_questionnarie = StudentQuestionnarie.query.filter_by(id=id).first()
-        db.session.delete(delete_questionnarie)
-        db.session.commit()
+        delete_questionnarie.delete()
 
         return jsonify({"msg": "Questionnarie deleted"}), 200
     
@@ -770,8 +1144,7 @@ def student_questionnaries(id = None):
         if name != '':
             update_questionnarie.name = name
 
-
-        db.session.commit()
+        update_questionnarie.update()
 
         return ({'msg': 'Questionnarie Updated'})  
 
@@ -779,17 +1152,20 @@ def student_questionnaries(id = None):
 @app.route('/student_questions', methods=['GET', 'POST'])
 @app.route('/student_questions/<int:id>', methods=['GET', 'PUT', 'DELETE'])
 @jwt_required
+@conditional('student_questions')
 def student_questions(id = None):
     if request.method == 'GET':
         if id is not None:
-            student_question = StudentQuestion.query.get(id) # None por defecto si no consigue el registro
+            student_question = get_cached(StudentQuestion, "id", id) # None por defecto si no consigue el registro
             if student_question:
-                return jsonify(student_question.serialize()), 200
+                return jsonify(shape_item(student_question, StudentQuestion)), 200
             return jsonify({"msg": "Student Question not found"}), 404
         else:
-            student_question = StudentQuestion.query.all()
-            student_question = list(map(lambda student_question: student_question.serialize(), student_question))
-            return jsonify(student_question), 200
+            found = multi_get(StudentQuestion.query, StudentQuestion)
+            if found is not None:
+                return json_response(found), 200
+            student_question = paginate(StudentQuestion.query, StudentQuestion)
+            return json_response(student_question), 200
 
     if request.method == 'POST':
 
@@ -798,10 +1174,6 @@ def student_questions(id = None):
         if not question:
             return jsonify({"msg": "Question is required"}), 400
         
-        student_question = StudentQuestion.query.filter_by(id=id).first()
-        if student_question:
-            return jsonify({"msg": "Question already exists"}), 400
-        
         student_question = StudentQuestion()
         student_question.question = question
         student_question.questionnarie_id = request.json.get("questionnarie_id", None)
@@ -813,8 +1185,7 @@ def student_questions(id = None):
     if request.method == 'DELETE':
 
         delete_question = StudentQuestion.query.filter_by(id=id).first()
-        db.session.delete(delete_question)
-        db.session.commit()
+        delete_question.delete()
 
         return jsonify({"msg": "Question deleted"}), 200
     
@@ -826,24 +1197,29 @@ def student_questions(id = None):
         if question != '':
             update_question.question = question
     
-        db.session.commit()
+        update_question.update()
 
         return ({'msg': 'Question Updated'}) 
 
 @app.route('/teacher_answers', methods=['GET', 'POST'])
 @app.route('/teacher_answers/<int:id>', methods=['GET', 'PUT', 'DELETE'])
 @jwt_required
+@conditional('teacher_answers')
 def teacher_answer(id = None):
     if request.method == 'GET':
         if id is not None:
-            teacher_answer = TeacherAnswer.query.get(id) # None por defecto si no consigue el registro
+            teacher_answer = get_cached(TeacherAnswer, "id", id) # None por defecto si no consigue el registro
             if teacher_answer:
-                return jsonify(teacher_answer.serialize()), 200
+                return jsonify(shape_item(teacher_answer, TeacherAnswer)), 200
             return jsonify({"msg": "Teacher Answer not found"}), 404
         else:
-            teacher_answer = TeacherAnswer.query.all()
-            teacher_answer = list(map(lambda teacher_answer: teacher_answer.serialize(), teacher_answer))
-            return jsonify(teacher_answer), 200
+            found = multi_get(TeacherAnswer.query, TeacherAnswer)
+            if found is not None:
+                return json_response(found), 200
+            if wants_stream():
+                return stream_ndjson(TeacherAnswer.query, TeacherAnswer)
+            teacher_answer = paginate(TeacherAnswer.query, TeacherAnswer)
+            return json_response(teacher_answer), 200
 
     if request.method == 'POST':
 
@@ -883,8 +1259,7 @@ def teacher_answer(id = None):
     if request.method == 'DELETE':
 
         delete_answer = TeacherAnswer.query.filter_by(id=id).first()
-        db.session.delete(delete_answer)
-        db.session.commit()
+        delete_answer.delete()
 
         return jsonify({"msg": "Answer deleted"}), 200
     
@@ -896,11 +1271,176 @@ def teacher_answer(id = None):
         if answer != '':
             update_answer.answer = answer
     
-        db.session.commit()
+        update_answer.update()
 
         return ({'msg': 'Answer Updated'})  
 
 
+@app.route('/teacher_questionnaries/<int:id>/analytics', methods=['GET'])
+@jwt_required
+def teacher_questionnarie_analytics(id):
+    questionnarie = TeacherQuestionnarie.query.get(id)
+    if not questionnarie:
+        return jsonify({"msg": "Questionarie not found"}), 404
+
+    cohort = request.args.get("cohort", None)
+
+    # counts come from the incrementally maintained rollup, the response grows with questions and not with answers
+    query = db.session.query(
+        TeacherAnswerRollup.question_id, TeacherAnswerRollup.answer, db.func.sum(TeacherAnswerRollup.total)
+    ).filter(TeacherAnswerRollup.questionnarie_id == id, TeacherAnswerRollup.total != 0)
+    if cohort:
+        query = query.filter(TeacherAnswerRollup.cohort == cohort)
+    query = query.group_by(TeacherAnswerRollup.question_id, TeacherAnswerRollup.answer)
+
+    questions = {}
+    for question in TeacherQuestion.query.filter_by(questionnarie_id=id).order_by(TeacherQuestion.id):
+        questions[question.id] = {"question_id": question.id, "question": question.question, "total": 0, "answers": {}}
+
+    for question_id, answer, count in query:
+        question = questions.setdefault(question_id, {"question_id": question_id, "question": None, "total": 0, "answers": {}})
+        question["answers"][answer] = int(count)
+        question["total"] += int(count)
+
+    return jsonify({
+        "questionnarie_id": id,
+        "cohort": cohort,
+        "questions": list(questions.values())
+    }), 200
+
+
+@app.route('/teacher_answers/batch', methods=['POST'])
+@jwt_required
+def teacher_answers_batch():
+    email = get_jwt_identity()
+    teacher_user = TeacherUser.query.filter_by(email=email).first()
+    if not teacher_user:
+        return jsonify({"msg": "Teacher not found"}), 404
+
+    questionnarie_id = request.json.get("questionnarie_id", None)
+    breathecode_id = request.json.get("breathecode_id", None)
+    answers = request.json.get("answers", None)
+
+    if not questionnarie_id:
+        return jsonify({"msg": "Questionnarie_id is required"}), 400
+    if not breathecode_id:
+        return jsonify({"msg": "Breathecode_id is required"}), 400
+    if not answers or not isinstance(answers, list):
+        return jsonify({"msg": "Answers are required"}), 400
+
+    rows = {}
+    for index, item in enumerate(answers):
+        if not isinstance(item, dict) or not item.get("answer"):
+            return jsonify({"msg": "Answer is required", "index": index}), 400
+        if not isinstance(item["answer"], str):
+            return jsonify({"msg": "Answer must be a string", "index": index}), 400
+        question_id = item.get("teacher_question_id")
+        if not question_id:
+            return jsonify({"msg": "Question_id is required", "index": index}), 400
+        # a list or dict can not be a key below and true would pass as question 1
+        if not isinstance(question_id, int) or isinstance(question_id, bool):
+            return jsonify({"msg": "Question_id must be an integer", "index": index}), 400
+        # the last answer for a question wins, one statement can not upsert the same key twice
+        rows[question_id] = {
+            "teacher_question_id": question_id,
+            "answer": item["answer"],
+            "questionnarie_id": questionnarie_id,
+            "breathecode_id": breathecode_id,
+            "teacher_user": teacher_user.id
+        }
+
+    known = {question_id for (question_id,) in db.session.query(TeacherQuestion.id).filter(
+        TeacherQuestion.questionnarie_id == questionnarie_id,
+        TeacherQuestion.id.in_(list(rows))
+    )}
+    unknown = [question_id for question_id in rows if question_id not in known]
+    if unknown:
+        return jsonify({"msg": "Questions not in questionnarie", "question_ids": unknown}), 400
+
+    upsert_teacher_answers(list(rows.values()))
+
+    return jsonify({"success": "Teacher Answers Register Successfully", "answers": len(rows)}), 200
+
+
+
+@app.route('/ledger/<string:rut>', methods=['GET'])
+@jwt_required
+def ledger(rut):
+    rut = normalize_rut(rut)
+    if not rut:
+        return jsonify({"msg": "RUT is not valid"}), 400
+
+    def total(model):
+        return db.select([db.func.coalesce(db.func.sum(model.amount), 0)]).where(model.rut == rut).as_scalar()
+
+    # the three sums travel in a single round trip, each one an index lookup on rut
+    invoiced, paid, credited = db.session.query(total(Invoice), total(Payment), total(CreditNote)).one()
+
+    return jsonify({
+        "rut": rut,
+        "invoiced": money(invoiced),
+        "paid": money(paid),
+        "credited": money(credited),
+        "outstanding": money(invoiced - credited - paid)
+    }), 200
+
+@app.route('/students/<int:breathecode_id>/dossier', methods=['GET'])
+@jwt_required
+@conditional(*DOSSIER_TABLES)
+def student_dossier(breathecode_id):
+    dossier = cached_dossier(breathecode_id)
+    if not dossier:
+        return jsonify({"msg": "Student not found"}), 404
+    return json_response(dossier), 200
+
+@app.route('/reports/cohort_finance', methods=['GET'])
+@jwt_required
+def cohort_finance_report():
+    report = cohort_financial_report()
+
+    if request.args.get("format") == "csv":
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=["cohort", "month", "expected", "collected", "arrears", "collection_rate"])
+        writer.writeheader()
+        writer.writerows(report_rows(report))
+        return Response(output.getvalue(), mimetype='text/csv', headers={"Content-Disposition": "attachment; filename=cohort_finance.csv"})
+
+    return jsonify(report), 200
+
+@app.cli.command('rebuild-rollups')
+@click.option('--check', is_flag=True, help='Only report rollup rows that differ from the answer tables.')
+def rebuild_rollups_command(check):
+    mismatches = rebuild_rollups(check=check)
+    if check:
+        click.echo('{} rollup rows out of date'.format(mismatches))
+    else:
+        click.echo('Rollups rebuilt')
+
+@app.cli.command('benchmark-serialization')
+@click.option('--rows', default=50000, help='Rows generated per table.')
+@click.option('--repeat', default=3, help='Runs per path, the fastest one is reported.')
+def benchmark_serialization_command(rows, repeat):
+    for result in serialization_benchmark(rows, repeat):
+        click.echo('{table} ({rows} rows, {encoder}): orm {orm_rows_per_s} rows/s, core {core_rows_per_s} rows/s, x{speedup}'.format(**result))
+
+@app.cli.command('benchmark-report')
+@click.option('--students', default=100000, help='Students generated, each with a financing plan and payments.')
+@click.option('--repeat', default=3, help='Runs, the fastest one is reported.')
+def benchmark_report_command(students, repeat):
+    result = report_benchmark(students, repeat)
+    click.echo('cohort finance report: {students} students, {payments} payments, {cohorts} cohorts in {seconds}s'.format(**result))
+
+@app.cli.command('check-filter-indexes')
+def check_filter_indexes_command():
+    missing = 0
+    for result in check_filter_indexes():
+        if result["indexes"]:
+            click.echo('{table}?{filter}: {indexes}'.format(table=result["table"], filter=result["filter"], indexes=", ".join(result["indexes"])))
+        else:
+            missing += 1
+            click.echo('{table}?{filter}: NO INDEX'.format(**result))
+    if missing:
+        raise click.ClickException('{} filters are not served by an index'.format(missing))
 
 # this only runs if `$ python src/main.py` is executed
 if __name__ == '__main__':
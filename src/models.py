@@ -1,9 +1,90 @@
+from flask import g, request, has_request_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, ForeignKey, Integer, String
-from datetime import datetime
+from sqlalchemy import Column, ForeignKey, Integer, String, select, union_all, literal, literal_column, func, tuple_, event
+from sqlalchemy.orm import attributes
+from sqlalchemy.sql.dml import Insert, Update, Delete
+from cache import EntityCache
+from sqlalchemy.dialects import postgresql, mysql
+from datetime import datetime, date
+from decimal import Decimal
+import calendar
 
 db = SQLAlchemy()
 
+entity_cache = EntityCache.from_env()
+
+# alternate keys entities are cached under, besides their id
+CACHE_KEYS = {
+    "Financing": ["rut"],
+    "EnrrollmentAgreement": ["breathecode_id"]
+}
+
+def cache_key(model_name, attr, value):
+    return "{}:{}:{}".format(model_name, attr, value)
+
+def cache_keys(obj):
+    # keys for the current and the not yet committed previous values, so changing a rut drops both entries
+    name = type(obj).__name__
+    keys = set()
+    for attr in ["id"] + CACHE_KEYS.get(name, []):
+        history = attributes.get_history(obj, attr)
+        for value in list(history.deleted or ()) + [getattr(obj, attr)]:
+            if value is not None:
+                keys.add(cache_key(name, attr, value))
+    return keys
+
+def get_cached(model, attr, value):
+    # serialized entity looked up by id or by one of its CACHE_KEYS, None when it does not exist
+    def load():
+        if attr == "id":
+            item = model.query.get(value)
+        else:
+            item = model.query.filter(getattr(model, attr) == value).first()
+        return item.serialize() if item else None
+    version = table_versions([model.__tablename__])[0]
+    return entity_cache.get_or_load(cache_key(model.__name__, attr, value), load, version=version)
+
+# roles is a tiny lookup table that almost never changes, so user serialization
+# reads it from a process-local copy instead of lazy loading user.role per row.
+# The copy is tagged with the roles table version, the same one the ETags are built from,
+# so a role change made by any process is picked up by the next request.
+_role_cache = {}
+_role_cache_version = None
+
+def cached_role(role_id):
+    global _role_cache, _role_cache_version
+    version = table_versions(['roles'])[0]
+    if version != _role_cache_version or role_id not in _role_cache:
+        _role_cache = {role.id: role.serialize() for role in Role.query.all()}
+        _role_cache_version = version
+    role = _role_cache.get(role_id)
+    return dict(role) if role is not None else None
+
+def clear_role_cache():
+    global _role_cache_version
+    _role_cache_version = None
+
+# money is stored as exact NUMERIC and sent to clients as a decimal string, like the old String columns
+MONEY = db.Numeric(14, 2)
+
+# canonical rut text, see rut.normalize_rut
+RUT = db.String(12)
+
+def money(value):
+    return str(value) if value is not None else None
+
+def iso(value):
+    return value.isoformat() if value is not None else None
+
+# months from a financing agreement to its first installment; the schedule and the cohort report share it
+FIRST_DUE_OFFSET = 1
+
+def add_months(start, months):
+    # same day of the month, clamped to the month length (jan 31 + 1 month = feb 28/29)
+    index = start.year * 12 + start.month - 1 + months
+    year, month = index // 12, index % 12 + 1
+    return date(year, month, min(start.day, calendar.monthrange(year, month)[1]))
+
 class Role(db.Model):
     __tablename__ = 'roles'
     id = db.Column(db.Integer, primary_key=True)
@@ -23,18 +104,31 @@ class Role(db.Model):
         }
 
     def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
+        clear_role_cache()
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
+        clear_role_cache()
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
+        clear_role_cache()
 
 class StaffUser(db.Model):
     __tablename__ = 'staff_users'
+    __table_args__ = (
+        # filtered lists are paginated on id, so the index carries it after the filter column
+        db.Index('ix_staff_users_is_active', 'is_active', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), unique=False, default="")
     lastName = db.Column(db.String(120), unique=False, default="")
@@ -48,30 +142,44 @@ class StaffUser(db.Model):
     def __repr__(self):
         return f"staffUser('{self.name}', '{self.lastName}', '{self.email}','{self.password}')"
 
+    # serialize() field -> column it is read from, or (column, formatter); ?fields= selects only these columns
+    FIELDS = {"id": "id", "name": "name", "lastName": "lastName", "email": "email", "role": ("role_id", cached_role)}
+    # ?param -> column; equality filter, or ?<param>_from= / ?<param>_to= on DateTime columns
+    FILTERS = {"is_active": "is_active"}
+
     def serialize(self):
         return {
             "id": self.id,
             "name": self.name,
             "lastName": self.lastName,
             "email": self.email,
-            "role": self.role.serialize()
+            "role": cached_role(self.role_id)
 
             # do not serialize the password, its a security breach
         }
 
     def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
 class TeacherUser(db.Model):
     __tablename__ = 'teacher_users'
+    __table_args__ = (
+        db.Index('ix_teacher_users_is_active', 'is_active', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), unique=False, default="")
     lastName = db.Column(db.String(120), unique=False, default="")
@@ -83,30 +191,42 @@ class TeacherUser(db.Model):
     def __repr__(self):
         return f"teacherUser('{self.name}', '{self.lastName}', '{self.email}','{self.password}')"
 
+    FIELDS = {"id": "id", "name": "name", "lastName": "lastName", "email": "email", "role": ("role_id", cached_role)}
+    FILTERS = {"is_active": "is_active"}
+
     def serialize(self):
         return {
             "id": self.id,
             "name": self.name,
             "lastName": self.lastName,
             "email": self.email,
-            "role": self.role.serialize()
+            "role": cached_role(self.role_id)
             
             # do not serialize the password, its a security breach
         }
     
     def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
 class StudentUser(db.Model):
     __tablename__ = 'student_users'
+    __table_args__ = (
+        db.Index('ix_student_users_is_active', 'is_active', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), unique=False, default="")
     lastName = db.Column(db.String(120), unique=False, default="")
@@ -119,30 +239,80 @@ class StudentUser(db.Model):
     def __repr__(self):
         return f"studentUser('{self.name}', '{self.lastName}', '{self.email}','{self.password}')"
 
+    FIELDS = {"id": "id", "name": "name", "lastName": "lastName", "email": "email", "role": ("role_id", cached_role)}
+    FILTERS = {"is_active": "is_active"}
+
     def serialize(self):
         return {
             "id": self.id,
             "name": self.name,
             "lastName": self.lastName,
             "email": self.email,
-            "role": self.role.serialize()
+            "role": cached_role(self.role_id)
             
             # do not serialize the password, its a security breach
         }
     
     def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
+
+# account type -> model, in the order /login resolves an email present in more than one table
+ACCOUNT_MODELS = [
+    ("staff", StaffUser),
+    ("teacher", TeacherUser),
+    ("student", StudentUser)
+]
+
+def email_key(column):
+    # The expression emails are compared on, always against lower case values. MySQL compares
+    # with a case-insensitive collation, so the bare column keeps the unique email index usable;
+    # wrapping it in lower() would scan the table. Postgres and SQLite have lower(email) indexes.
+    if db.session.get_bind().dialect.name == 'mysql':
+        return column
+    return func.lower(column)
+
+def find_account(email):
+    # one UNION ALL over the three user tables, each branch served by a case-insensitive email index
+    email = email.strip().lower()
+    branches = []
+    for priority, (kind, model) in enumerate(ACCOUNT_MODELS):
+        branches.append(select([
+            literal(priority).label("priority"),
+            literal(kind).label("kind"),
+            model.id, model.name, model.lastName, model.email, model.password, model.role_id
+        ]).where(email_key(model.email) == email))
+    query = union_all(*branches).order_by(literal_column("priority")).limit(1)
+    return db.session.execute(query).first()
+
+def serialize_account(account):
+    return {
+        "id": account.id,
+        "name": account.name,
+        "lastName": account.lastName,
+        "email": account.email,
+        "role": cached_role(account.role_id)
+    }
 
 class Profile(db.Model):
     __tablename__ = 'profiles'
+    __table_args__ = (
+        db.Index('ix_profiles_cohort', 'cohort', 'id'),
+        db.Index('ix_profiles_size', 'size', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('student_users.id'), nullable=False)
     breathecode_id = db.Column(db.Integer, unique=True, nullable=False)
@@ -153,7 +323,7 @@ class Profile(db.Model):
     address = db.Column(db.String(200), unique=False, nullable=False)
     phone = db.Column(db.String(120), unique=False, nullable=False)
     cohort = db.Column(db.String(80), unique=False, nullable=False)
-    rut = db.Column(db.String(100), unique=True, nullable=False)
+    rut = db.Column(RUT, unique=True, nullable=False)
     enrrollment_agreement = db.relationship("EnrrollmentAgreement", backref="agreement", uselist=False)
     financing_agreement = db.relationship("Financing", backref="financing", uselist=False)
     credit_notes = db.relationship('CreditNote', backref='credit_note', lazy=True)
@@ -163,6 +333,11 @@ class Profile(db.Model):
     def __repr__(self):
         return f"profile('{self.breathecode_id}', '{self.size}', '{self.address}','{self.phone}', '{self.cohort}', '{self.rut}')"
 
+    FIELDS = {"id": "id", "breathecode_id": "breathecode_id", "student_id": "student_id", "size": "size", "address": "address", "phone": "phone", "cohort": "cohort", "rut": "rut", "name": "name", "lastName": "lastName", "email": "email"}
+    # ?include= name -> relationship, loaded with one IN query per include
+    INCLUDES = {"enrrollment_agreement": "enrrollment_agreement", "financing_agreement": "financing_agreement", "payments": "payments", "invoices": "invoices", "credit_notes": "credit_notes"}
+    FILTERS = {"cohort": "cohort", "size": "size"}
+
     def serialize(self):
       
         return {
@@ -182,15 +357,21 @@ class Profile(db.Model):
         }
 
     def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
 class EnrrollmentAgreement(db.Model):
     __tablename__ = 'enrrollment_agreements'
@@ -202,6 +383,8 @@ class EnrrollmentAgreement(db.Model):
     def __repr__(self):
         return f"agreement('{self.urlPDF}', '{self.breathecode_id}')"
 
+    FIELDS = {"id": "id", "urlPDF": "urlPDF", "breathecode_id": "breathecode_id"}
+
     def serialize(self):
         return {
             "id": self.id,
@@ -211,69 +394,168 @@ class EnrrollmentAgreement(db.Model):
         }
 
     def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
 class Financing(db.Model):
     __tablename__ = 'financing_agreements'
     id = db.Column(db.Integer, primary_key=True)
     months = db.Column(db.Integer, unique=False, nullable=False)
-    monthlyFee = db.Column(db.String(100), unique=False, nullable=False)
+    monthlyFee = db.Column(MONEY, unique=False, nullable=False)
     date = db.Column(db.DateTime, default=datetime.utcnow)
-    rut = db.Column(db.String(100), db.ForeignKey('profiles.rut'), unique=True, nullable=False)
+    rut = db.Column(RUT, db.ForeignKey('profiles.rut'), unique=True, nullable=False)
     urlPDF = db.Column(db.String(200), unique=False, nullable=False)
+    installments = db.relationship('Installment', backref='agreement', lazy=True, cascade="all, delete-orphan", order_by='Installment.number')
 
     def __repr__(self):
         return f"financing('{self.months}', '{self.monthlyFee}', '{self.date}','{self.rut}', '{self.urlPDF}')"
 
+    def schedule(self):
+        # one installment per month, the first one due FIRST_DUE_OFFSET months after the agreement date
+        if self.date is None:
+            self.date = datetime.utcnow()
+        return [
+            Installment(number=number, due_date=add_months(self.date, number - 1 + FIRST_DUE_OFFSET), amount=self.monthlyFee)
+            for number in range(1, int(self.months) + 1)
+        ]
+
+
+    FIELDS = {"id": "id", "months": "months", "monthlyFee": ("monthlyFee", money), "urlPDF": "urlPDF", "rut": "rut"}
 
     def serialize(self):
         return {
             "id": self.id,
             "months": self.months,
-            "monthlyFee": self.monthlyFee,
+            "monthlyFee": money(self.monthlyFee),
             "urlPDF": self.urlPDF,
             "rut": self.rut
 
         }
 
     def save(self):
+        keys = cache_keys(self)
+        db.session.add(self)
+        db.session.commit()
+        entity_cache.invalidate(keys)
+
+    def update(self):
+        keys = cache_keys(self)
+        db.session.commit()
+        entity_cache.invalidate(keys)
+
+    def delete(self):
+        keys = cache_keys(self)
+        db.session.delete(self)
+        db.session.commit()
+        entity_cache.invalidate(keys)
+
+class Installment(db.Model):
+    __tablename__ = 'installments'
+    __table_args__ = (
+        db.UniqueConstraint('financing_id', 'number', name='unique_installment'),
+        # overdue lookups filter status by equality and due_date by range, so status goes first
+        db.Index('ix_installments_status_due_date', 'status', 'due_date'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    financing_id = db.Column(db.Integer, db.ForeignKey('financing_agreements.id'), nullable=False)
+    number = db.Column(db.Integer, nullable=False)
+    due_date = db.Column(db.Date, nullable=False)
+    amount = db.Column(MONEY, nullable=False)
+    paid_amount = db.Column(MONEY, nullable=False, default=0)
+    status = db.Column(db.String(20), nullable=False, default="pending")
+    payment_id = db.Column(db.Integer, db.ForeignKey('payments.id'), nullable=True)
+
+    def __repr__(self):
+        return f"installment('{self.financing_id}', '{self.number}', '{self.due_date}', '{self.amount}', '{self.status}')"
+
+    FIELDS = {"id": "id", "financing_id": "financing_id", "number": "number", "due_date": ("due_date", iso), "amount": ("amount", money), "paid_amount": ("paid_amount", money), "status": "status", "payment_id": "payment_id"}
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "financing_id": self.financing_id,
+            "number": self.number,
+            "due_date": self.due_date.isoformat() if self.due_date else None,
+            "amount": money(self.amount),
+            "paid_amount": money(self.paid_amount),
+            "status": self.status,
+            "payment_id": self.payment_id
+        }
+
+    def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
+
+def allocate_payment(payment):
+    # settles the oldest pending installments of the payer's agreement with the payment amount;
+    # the caller commits, so the payment and the installments change together
+    financing = Financing.query.filter_by(rut=payment.rut).first()
+    if not financing:
+        return []
+
+    remaining = Decimal(payment.amount)
+    settled = []
+    pending = Installment.query.filter_by(financing_id=financing.id, status="pending").order_by(Installment.number)
+    for installment in pending:
+        if remaining <= 0:
+            break
+        applied = min(remaining, installment.amount - installment.paid_amount)
+        installment.paid_amount += applied
+        remaining -= applied
+        if installment.paid_amount >= installment.amount:
+            installment.status = "paid"
+            installment.payment_id = payment.id
+            settled.append(installment)
+    return settled
 
 class Payment(db.Model):
     __tablename__ = 'payments'
     id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.DateTime, default=datetime.utcnow)
-    amount = db.Column(db.String(100), unique=False, nullable=False)
+    date = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    amount = db.Column(MONEY, unique=False, nullable=False)
     urlPDF = db.Column(db.String(200), unique=False, nullable=False)
     payment_method = db.Column(db.String(200), unique=False, nullable=False)
     bank = db.Column(db.String(200), unique=False, nullable=False)
-    rut = db.Column(db.Integer, db.ForeignKey('profiles.rut'), unique=True, nullable=False)
+    rut = db.Column(RUT, db.ForeignKey('profiles.rut'), index=True, nullable=False)
 
 
     def __repr__(self):
         return f"payment('{self.date}', '{self.amount}', '{self.urlPDF}','{self.payment_method}', '{self.bank}', '{self.rut}')"
 
 
+    FIELDS = {"id": "id", "amount": ("amount", money), "urlPDF": "urlPDF", "payment_method": "payment_method", "bank": "bank", "rut": "rut"}
+    FILTERS = {"date": "date"}
+
     def serialize(self):
         return {
             "id": self.id,
-            "amount": self.amount,
+            "amount": money(self.amount),
             "urlPDF": self.urlPDF,
             "payment_method": self.payment_method,
             "bank": self.bank,
@@ -282,79 +564,102 @@ class Payment(db.Model):
         }
 
     def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
 class Invoice(db.Model):
     __tablename__ = 'invoices'
     id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.DateTime, default=datetime.utcnow)
-    amount = db.Column(db.String(100), unique=False, nullable=False)
+    date = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    amount = db.Column(MONEY, unique=False, nullable=False)
     urlPDF = db.Column(db.String(200), unique=False, nullable=False)
-    rut = db.Column(db.Integer, db.ForeignKey('profiles.rut'), unique=True, nullable=False)
+    rut = db.Column(RUT, db.ForeignKey('profiles.rut'), index=True, nullable=False)
 
 
     def __repr__(self):
         return f"payment('{self.date}', '{self.amount}', '{self.urlPDF}','{self.rut}')"
 
+    FIELDS = {"id": "id", "amount": ("amount", money), "urlPDF": "urlPDF", "rut": "rut"}
+    FILTERS = {"date": "date"}
+
     def serialize(self):
         return {
             "id": self.id,
-            "amount": self.amount,
+            "amount": money(self.amount),
             "urlPDF": self.urlPDF,
             "rut": self.rut
 
         }
 
     def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
 class CreditNote(db.Model):
     __tablename__ = 'credit_notes'
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.DateTime, default=datetime.utcnow)
-    amount = db.Column(db.String(100), unique=False, nullable=False)
+    amount = db.Column(MONEY, unique=False, nullable=False)
     urlPDF = db.Column(db.String(200), unique=False, nullable=False)
-    rut = db.Column(db.String, db.ForeignKey('profiles.rut'), unique=True, nullable=False)
+    rut = db.Column(RUT, db.ForeignKey('profiles.rut'), index=True, nullable=False)
 
 
     def __repr__(self):
         return f"payment('{self.date}', '{self.amount}', '{self.urlPDF}', '{self.rut}')"
 
+    FIELDS = {"id": "id", "amount": ("amount", money), "urlPDF": "urlPDF", "rut": "rut"}
+
     def serialize(self):
         return {
             "id": self.id,
-            "amount": self.amount,
+            "amount": money(self.amount),
             "urlPDF": self.urlPDF,
             "rut": self.rut
             
         }
 
     def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
 class JobProfile(db.Model):
     __tablename__ = 'job_profiles'
@@ -362,6 +667,8 @@ class JobProfile(db.Model):
     breathecode_id = db.Column(db.Integer, db.ForeignKey('profiles.breathecode_id'), unique=True, nullable=False)
     urlPDF = db.Column(db.String(200), unique=False, nullable=False)
 
+    FIELDS = {"id": "id", "breathecode_id": "breathecode_id", "urlPDF": "urlPDF"}
+
     def serialize(self):
         return {
             "id": self.id,
@@ -370,25 +677,33 @@ class JobProfile(db.Model):
         }
 
     def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
 class Rut(db.Model):
     __tablename__ = 'ruts'
     id = db.Column(db.Integer, primary_key=True)
-    rut_id = db.Column(db.Integer, db.ForeignKey('profiles.rut'), unique=True, nullable=False)
+    rut_id = db.Column(RUT, db.ForeignKey('profiles.rut'), unique=True, nullable=False)
     urlPDF = db.Column(db.String(200), unique=False, nullable=False)
     
     def __repr__(self):
         return f"rut('{self.rut_id}', '{self.urlPDF}')"
 
+    FIELDS = {"id": "id", "rut_id": "rut_id", "urlPDF": "urlPDF"}
+
     def serialize(self):
         return {
             "id": self.id,
@@ -397,15 +712,21 @@ class Rut(db.Model):
         }
 
     def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
 class TeacherQuestionnarie(db.Model):
     __tablename__ = 'teacher_questionnaries'
@@ -415,6 +736,9 @@ class TeacherQuestionnarie(db.Model):
     questionnarie_details = db.Column(db.String(200), unique=False, nullable=False)
     teacher_question = db.relationship('TeacherQuestion', backref='questions', lazy=True, cascade="all, delete-orphan")
     
+    FIELDS = {"id": "id", "staff_user": "staff_user", "name": "name", "questionnarie_details": "questionnarie_details"}
+    INCLUDES = {"questions": "teacher_question"}
+
     def serialize(self):
         return {
             "id": self.id,
@@ -425,23 +749,35 @@ class TeacherQuestionnarie(db.Model):
         }
 
     def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
 class TeacherQuestion(db.Model):
     __tablename__ = 'teacher_questions'
+    __table_args__ = (
+        db.Index('ix_teacher_questions_is_active', 'is_active', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     questionnarie_id = db.Column(db.Integer, db.ForeignKey('teacher_questionnaries.id'), unique=False, nullable=False)
     question = db.Column(db.String(200), unique=False, nullable=False)
     is_active = db.Column(db.Boolean(), default=True)
 
+    FIELDS = {"id": "id", "question": "question", "questionnarie_id": "questionnarie_id"}
+    FILTERS = {"is_active": "is_active"}
+
     def serialize(self):
 
         return {
@@ -451,29 +787,40 @@ class TeacherQuestion(db.Model):
         }
 
     def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
 class TeacherAnswer(db.Model):
     __tablename__ = 'teacher_answers' 
     __table_args__ = (
         db.UniqueConstraint('breathecode_id', 'teacher_user', 'teacher_question_id' , name='unique_teacher_answer'),
+        db.Index('ix_teacher_answers_questionnarie_question', 'questionnarie_id', 'teacher_question_id'),
+        db.Index('ix_teacher_answers_breathecode_id', 'breathecode_id'),
     )
     id = db.Column(db.Integer, primary_key=True)
     teacher_question_id = db.Column(db.Integer, db.ForeignKey('teacher_questions.id'), unique=False, nullable=False)
     answer = db.Column(db.String(200), unique=False, nullable=False)
     breathecode_id = db.Column(db.Integer, db.ForeignKey('profiles.breathecode_id'), unique=False, nullable=False)
-    date = db.Column(db.DateTime, default=datetime.utcnow)
+    date = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     questionnarie_id = db.Column(db.Integer, db.ForeignKey('teacher_questionnaries.id'), unique=False, nullable=False)
     teacher_user = db.Column(db.Integer, db.ForeignKey('teacher_users.id'), unique=False, nullable=False)
 
+    FIELDS = {"id": "id", "questionnarie_id": "questionnarie_id", "answer": "answer", "teacher_user": "teacher_user", "breathecode_id": "breathecode_id", "date": ("date", iso), "question_id": "teacher_question_id"}
+    FILTERS = {"questionnarie_id": "questionnarie_id", "breathecode_id": "breathecode_id", "date": "date"}
+
     def serialize(self):
         return {
             "id": self.id,
@@ -481,20 +828,101 @@ class TeacherAnswer(db.Model):
             "answer": self.answer,
             "teacher_user": self.teacher_user,
             "breathecode_id": self.breathecode_id,
-            "date": self.date,
+            "date": iso(self.date),
             "question_id": self.teacher_question_id
         }
 
     def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
+
+def upsert_teacher_answers(rows):
+    # rows are dicts with the TeacherAnswer columns; a row that hits unique_teacher_answer
+    # replaces the stored answer instead of failing
+    if not rows:
+        return
+    dialect = db.session.get_bind().dialect.name
+    now = datetime.utcnow()
+    for row in rows:
+        row.setdefault("date", now)
+    keys = [(row["breathecode_id"], row["teacher_user"], row["teacher_question_id"]) for row in rows]
+    key_columns = tuple_(TeacherAnswer.breathecode_id, TeacherAnswer.teacher_user, TeacherAnswer.teacher_question_id)
+    changes = []
+
+    inserted = set()
+    if dialect == "postgresql":
+        # Answers nobody has stored yet go in first. DO NOTHING waits for a concurrent insert of the
+        # same key to finish, so every key left afterwards exists and can be locked below.
+        stmt = postgresql.insert(TeacherAnswer.__table__).values(rows) \
+            .on_conflict_do_nothing(constraint="unique_teacher_answer") \
+            .returning(TeacherAnswer.breathecode_id, TeacherAnswer.teacher_user, TeacherAnswer.teacher_question_id)
+        inserted = {tuple(key) for key in db.session.execute(stmt)}
+        for key, row in zip(keys, rows):
+            if key in inserted:
+                changes.append((TeacherAnswerRollup, row["questionnarie_id"], row["teacher_question_id"], row["breathecode_id"], row["answer"], 1))
+    pending = [(key, row) for key, row in zip(keys, rows) if key not in inserted]
+
+    # the stored answers being replaced, locked until commit so a concurrent submission for the
+    # same key waits and then sees this one's answer; mysql also gap locks the keys still missing
+    existing = {}
+    if pending:
+        locked = TeacherAnswer.query.filter(key_columns.in_([key for key, row in pending])).with_for_update()
+        existing = {
+            (answer.breathecode_id, answer.teacher_user, answer.teacher_question_id): answer
+            for answer in locked
+        }
+    stale = set().union(*[cache_keys(answer) for answer in existing.values()])
+
+    if dialect in ("postgresql", "mysql"):
+        if pending and dialect == "postgresql":
+            stmt = postgresql.insert(TeacherAnswer.__table__).values([row for key, row in pending])
+            stmt = stmt.on_conflict_do_update(constraint="unique_teacher_answer", set_={
+                "answer": stmt.excluded.answer,
+                "date": stmt.excluded.date,
+                "questionnarie_id": stmt.excluded.questionnarie_id
+            })
+            db.session.execute(stmt)
+        elif pending:
+            stmt = mysql.insert(TeacherAnswer.__table__).values([row for key, row in pending])
+            stmt = stmt.on_duplicate_key_update(
+                answer=stmt.inserted.answer,
+                date=stmt.inserted.date,
+                questionnarie_id=stmt.inserted.questionnarie_id
+            )
+            db.session.execute(stmt)
+
+        # core statements skip the flush hook, so the rollup changes are applied here
+        for key, row in pending:
+            if key in existing:
+                old = existing[key]
+                changes.append((TeacherAnswerRollup, old.questionnarie_id, old.teacher_question_id, old.breathecode_id, old.answer, -1))
+            changes.append((TeacherAnswerRollup, row["questionnarie_id"], row["teacher_question_id"], row["breathecode_id"], row["answer"], 1))
+        apply_rollup_changes(db.session.connection(), changes)
+    else:
+        # no native upsert: update the conflicting rows and add the rest through the ORM
+        for key, row in pending:
+            if key in existing:
+                existing[key].answer = row["answer"]
+                existing[key].date = row["date"]
+                existing[key].questionnarie_id = row["questionnarie_id"]
+            else:
+                db.session.add(TeacherAnswer(**row))
+
+    db.session.commit()
+    entity_cache.invalidate(stale)
 
 class StudentQuestionnarie(db.Model):
     __tablename__ = 'student_questionnaries'
@@ -507,6 +935,9 @@ class StudentQuestionnarie(db.Model):
     def __repr__(self):
         return f"student_questionnaries('{self.staff_user}', '{self.questionnarie_details}')"
 
+    FIELDS = {"id": "id", "staff_user": "staff_user", "name": "name", "questionnarie_details": "questionnarie_details"}
+    INCLUDES = {"questions": "student_question"}
+
     def serialize(self):
         return {
             "id": self.id,
@@ -516,23 +947,35 @@ class StudentQuestionnarie(db.Model):
         }
 
     def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
 class StudentQuestion(db.Model):
     __tablename__ = 'student_questions'
+    __table_args__ = (
+        db.Index('ix_student_questions_is_active', 'is_active', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     questionnarie_id = db.Column(db.Integer, db.ForeignKey('student_questionnaries.id'), unique=False, nullable=False)
     question = db.Column(db.String(200), unique=False, nullable=False)
     is_active = db.Column(db.Boolean(), default=True)
 
+    FIELDS = {"id": "id", "questionnarie_id": "questionnarie_id", "question": "question"}
+    FILTERS = {"is_active": "is_active"}
+
     def serialize(self):
         return {
             "id": self.id,
@@ -541,15 +984,21 @@ class StudentQuestion(db.Model):
         }
 
     def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
 class StudentAnswer(db.Model):
     __tablename__ = 'student_answers'
@@ -575,12 +1024,220 @@ class StudentAnswer(db.Model):
         }
 
     def save(self):
+        keys = cache_keys(self)
         db.session.add(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def update(self):
+        keys = cache_keys(self)
         db.session.commit()
+        entity_cache.invalidate(keys)
 
     def delete(self):
+        keys = cache_keys(self)
         db.session.delete(self)
-        db.session.commit()
\ No newline at end of file
+        db.session.commit()
+        entity_cache.invalidate(keys)
+
+class TeacherAnswerRollup(db.Model):
+    __tablename__ = 'teacher_answer_rollups'
+    questionnarie_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    question_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    cohort = db.Column(db.String(80), primary_key=True)
+    answer = db.Column(db.String(200), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+    def serialize(self):
+        return {
+            "questionnarie_id": self.questionnarie_id,
+            "question_id": self.question_id,
+            "cohort": self.cohort,
+            "answer": self.answer,
+            "total": self.total
+        }
+
+class StudentAnswerRollup(db.Model):
+    __tablename__ = 'student_answer_rollups'
+    questionnarie_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    question_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    cohort = db.Column(db.String(80), primary_key=True)
+    answer = db.Column(db.String(200), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+    def serialize(self):
+        return {
+            "questionnarie_id": self.questionnarie_id,
+            "question_id": self.question_id,
+            "cohort": self.cohort,
+            "answer": self.answer,
+            "total": self.total
+        }
+
+# answer model -> (rollup model, name of its question column)
+ROLLUP_SOURCES = {
+    TeacherAnswer: (TeacherAnswerRollup, "teacher_question_id"),
+    StudentAnswer: (StudentAnswerRollup, "question_id")
+}
+
+def apply_rollup_changes(connection, changes):
+    # changes are (rollup model, questionnarie_id, question_id, breathecode_id, answer, delta)
+    breathecode_ids = {change[3] for change in changes}
+    if not breathecode_ids:
+        return
+    profiles = Profile.__table__
+    cohorts = dict(connection.execute(
+        select([profiles.c.breathecode_id, profiles.c.cohort]).where(profiles.c.breathecode_id.in_(breathecode_ids))
+    ).fetchall())
+
+    totals = {}
+    for rollup, questionnarie_id, question_id, breathecode_id, answer, delta in changes:
+        key = (rollup, questionnarie_id, question_id, cohorts.get(breathecode_id) or "", answer)
+        totals[key] = totals.get(key, 0) + delta
+
+    dialect = connection.dialect.name
+    for (rollup, questionnarie_id, question_id, cohort, answer), delta in totals.items():
+        if delta == 0:
+            continue
+        table = rollup.__table__
+        values = {"questionnarie_id": questionnarie_id, "question_id": question_id, "cohort": cohort, "answer": answer, "total": delta}
+        if dialect == "postgresql":
+            stmt = postgresql.insert(table).values(values)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.questionnarie_id, table.c.question_id, table.c.cohort, table.c.answer],
+                set_={"total": table.c.total + stmt.excluded.total}
+            )
+            connection.execute(stmt)
+        elif dialect == "mysql":
+            stmt = mysql.insert(table).values(values)
+            stmt = stmt.on_duplicate_key_update(total=table.c.total + stmt.inserted.total)
+            connection.execute(stmt)
+        else:
+            result = connection.execute(table.update().where(db.and_(
+                table.c.questionnarie_id == questionnarie_id,
+                table.c.question_id == question_id,
+                table.c.cohort == cohort,
+                table.c.answer == answer
+            )).values(total=table.c.total + delta))
+            if result.rowcount == 0:
+                connection.execute(table.insert().values(values))
+
+def _rollup_key(obj, question_attr, original=False):
+    def value(attr):
+        if original:
+            history = attributes.get_history(obj, attr)
+            if history.deleted:
+                return history.deleted[0]
+        return getattr(obj, attr)
+    return (value("questionnarie_id"), value(question_attr), value("breathecode_id"), value("answer"))
+
+@event.listens_for(db.session, "after_flush")
+def update_answer_rollups(session, flush_context):
+    # keeps the rollups in the same transaction as every answer written through the ORM
+    changes = []
+    for obj in session.new:
+        if type(obj) in ROLLUP_SOURCES:
+            rollup, question_attr = ROLLUP_SOURCES[type(obj)]
+            changes.append((rollup,) + _rollup_key(obj, question_attr) + (1,))
+    for obj in session.deleted:
+        if type(obj) in ROLLUP_SOURCES:
+            rollup, question_attr = ROLLUP_SOURCES[type(obj)]
+            changes.append((rollup,) + _rollup_key(obj, question_attr, original=True) + (-1,))
+    for obj in session.dirty:
+        if type(obj) in ROLLUP_SOURCES:
+            rollup, question_attr = ROLLUP_SOURCES[type(obj)]
+            before = _rollup_key(obj, question_attr, original=True)
+            after = _rollup_key(obj, question_attr)
+            if before != after:
+                changes.append((rollup,) + before + (-1,))
+                changes.append((rollup,) + after + (1,))
+    if changes:
+        apply_rollup_changes(session.connection(), changes)
+
+def rebuild_rollups(check=False):
+    # recomputes every rollup from the answer tables; with check=True only counts the rows that differ
+    mismatches = 0
+    for source, (rollup, question_attr) in ROLLUP_SOURCES.items():
+        question = getattr(source, question_attr)
+        cohort = func.coalesce(Profile.cohort, "")
+        query = db.session.query(source.questionnarie_id, question, cohort, source.answer, func.count(source.id)) \
+            .outerjoin(Profile, Profile.breathecode_id == source.breathecode_id) \
+            .group_by(source.questionnarie_id, question, cohort, source.answer)
+        expected = {tuple(row[:4]): row[4] for row in query}
+
+        if check:
+            current = {
+                (row.questionnarie_id, row.question_id, row.cohort, row.answer): row.total
+                for row in rollup.query.filter(rollup.total != 0)
+            }
+            mismatches += len(set(expected.items()) ^ set(current.items()))
+        else:
+            rollup.query.delete()
+            db.session.bulk_insert_mappings(rollup, [{
+                "questionnarie_id": questionnarie_id,
+                "question_id": question_id,
+                "cohort": cohort,
+                "answer": answer,
+                "total": total
+            } for (questionnarie_id, question_id, cohort, answer), total in expected.items()])
+
+    if not check:
+        db.session.commit()
+    return mismatches
+
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+    table_name = db.Column(db.String(80), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+def table_versions(tables):
+    # a GET reads the versions once: the ones conditional() read for the ETag are reused by the cache,
+    # so the body is always checked against the same versions its ETag was made from
+    known = g.setdefault("table_versions", {}) if has_request_context() and request.method == 'GET' else {}
+    missing = [table for table in tables if table not in known]
+    if missing:
+        rows = db.session.query(TableVersion.table_name, TableVersion.version).filter(TableVersion.table_name.in_(missing))
+        versions = dict(rows)
+        for table in missing:
+            known[table] = versions.get(table, 0)
+    return [known[table] for table in tables]
+
+def _bump_table_version(conn, clauseelement, multiparams, params, result):
+    # every INSERT/UPDATE/DELETE, whether it comes from a flush, a bulk operation or a core
+    # statement, bumps its table once per transaction; the bump commits or rolls back with the write
+    if not isinstance(clauseelement, (Insert, Update, Delete)):
+        return
+    table = clauseelement.table.name
+    bumped = conn.info.setdefault("bumped_tables", set())
+    if table == TableVersion.__tablename__ or table in bumped:
+        return
+    bumped.add(table)
+
+    # the first writers of a table not seeded by the migration would both miss the update and race
+    # on the insert, so the counter is upserted where the database can do it in one statement
+    versions = TableVersion.__table__
+    dialect = conn.dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(versions).values(table_name=table, version=1)
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=[versions.c.table_name],
+            set_={"version": versions.c.version + 1}
+        ))
+    elif dialect == "mysql":
+        stmt = mysql.insert(versions).values(table_name=table, version=1)
+        conn.execute(stmt.on_duplicate_key_update(version=versions.c.version + 1))
+    else:
+        # sqlite holds the database write lock from the write that got here, so nobody can insert in between
+        updated = conn.execute(
+            versions.update().where(versions.c.table_name == table).values(version=versions.c.version + 1)
+        )
+        if updated.rowcount == 0:
+            conn.execute(versions.insert().values(table_name=table, version=1))
+
+def _forget_bumped_tables(conn):
+    conn.info.pop("bumped_tables", None)
+
+def track_table_versions(engine):
+    event.listen(engine, "after_execute", _bump_table_version)
+    event.listen(engine, "commit", _forget_bumped_tables)
+    event.listen(engine, "rollback", _forget_bumped_tables)
@@ -0,0 +1,113 @@
+"""
+Matches bank statement lines against recorded payments
+"""
+from datetime import datetime, timedelta
+from decimal import Decimal
+from models import db, Payment
+from utils import APIException, parse_money
+from rut import normalize_rut
+
+DATE_FORMATS = ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%Y/%m/%d']
+CENT = Decimal('0.01')
+
+def normalize_amount(value):
+    amount = parse_money(value)
+    return amount.quantize(CENT) if amount is not None else None
+
+def parse_date(value):
+    value = (value or '').strip()[:10]
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            continue
+    return None
+
+def read_statement(rows):
+    # keeps only (line, rut, amount, date) per statement line, the rest of the CSV is dropped
+    lines = []
+    invalid = []
+    for index, row in enumerate(rows):
+        row = {(key or '').strip().lower(): value for key, value in row.items()}
+        rut = normalize_rut(row.get('rut'))
+        amount = normalize_amount(row.get('amount'))
+        date = parse_date(row.get('date'))
+        if not rut or amount is None or date is None:
+            invalid.append(index)
+        else:
+            lines.append((index, rut, amount, date))
+    return lines, invalid
+
+def reconcile(rows, tolerance_days=3):
+    lines, invalid = read_statement(rows)
+    if not lines:
+        raise APIException('The statement has no valid lines', status_code=400)
+
+    tolerance = timedelta(days=tolerance_days)
+    first = min(line[3] for line in lines) - tolerance
+    last = max(line[3] for line in lines) + tolerance
+
+    # every candidate payment of the window in one query, hashed on (rut, amount)
+    candidates = db.session.query(Payment.id, Payment.rut, Payment.amount, Payment.date).filter(
+        Payment.date >= datetime.combine(first, datetime.min.time()),
+        Payment.date < datetime.combine(last + timedelta(days=1), datetime.min.time())
+    ).yield_per(5000)
+
+    index = {}
+    for payment_id, rut, amount, date in candidates:
+        key = (rut, Decimal(amount).quantize(CENT))
+        index.setdefault(key, []).append((date.date(), payment_id))
+
+    used = set()
+    matched = []
+    ambiguous = []
+    unmatched = []
+
+    def assign(groups, candidates_of):
+        # Identical lines (same rut, amount and day) form one group and their candidates are
+        # interchangeable, so they are paired one to one in input order. Only a group with more
+        # candidates than lines can not tell which payments are its own.
+        leftover = []
+        for key, group in groups.items():
+            candidates = sorted(payment_id for payment_id in candidates_of(key) if payment_id not in used)
+            if len(candidates) > len(group):
+                ambiguous.extend({"line": number, "payment_ids": candidates} for number in group)
+                continue
+            for number, payment_id in zip(group, candidates):
+                used.add(payment_id)
+                matched.append({"line": number, "payment_id": payment_id})
+            leftover.extend((key, number) for number in group[len(candidates):])
+        return leftover
+
+    def group_lines(items):
+        groups = {}
+        for key, number in items:
+            groups.setdefault(key, []).append(number)
+        return groups
+
+    # first pass: same rut, amount and day
+    pending = assign(
+        group_lines(((rut, amount, date), number) for number, rut, amount, date in lines),
+        lambda key: [payment_id for day, payment_id in index.get(key[:2], []) if day == key[2]]
+    )
+
+    # second pass: same rut and amount within the date tolerance
+    pending = assign(
+        group_lines(pending),
+        lambda key: [payment_id for day, payment_id in index.get(key[:2], []) if abs(day - key[2]) <= tolerance]
+    )
+    for (rut, amount, date), number in pending:
+        unmatched.append({"line": number, "rut": rut, "amount": str(amount), "date": date.isoformat()})
+
+    for result in (matched, ambiguous, unmatched):
+        result.sort(key=lambda item: item["line"])
+    candidate_count = sum(len(payments) for payments in index.values())
+
+    return {
+        "window": {"from": first.isoformat(), "to": last.isoformat()},
+        "matched": matched,
+        "ambiguous": ambiguous,
+        "unmatched": unmatched,
+        "invalid_lines": invalid,
+        "unmatched_payments": candidate_count - len(used)
+    }
@@ -0,0 +1,108 @@
+"""
+Finance reports computed from grouped SQL aggregates instead of walking ORM objects
+"""
+import calendar
+from datetime import datetime
+from decimal import Decimal
+from models import db, Profile, Financing, Payment, FIRST_DUE_OFFSET
+
+def month_index(year, month):
+    return int(year) * 12 + int(month) - 1
+
+def month_label(index):
+    return "{:04d}-{:02d}".format(index // 12, index % 12 + 1)
+
+def rate(collected, due):
+    return round(float(collected / due), 4) if due else None
+
+def cohort_financial_report(until=None, session=None):
+    until = until or datetime.utcnow()
+    session = session or db.session
+    last_month = month_index(until.year, until.month)
+    month_days = calendar.monthrange(until.year, until.month)[1]
+
+    # financing plans grouped by (cohort, start day, length): one row per distinct plan shape, not per student
+    start_year = db.func.extract('year', Financing.date)
+    start_month = db.func.extract('month', Financing.date)
+    start_day = db.func.extract('day', Financing.date)
+    plans = session.query(
+        Profile.cohort, start_year, start_month, start_day, Financing.months, db.func.sum(Financing.monthlyFee)
+    ).join(Profile, Profile.rut == Financing.rut) \
+        .filter(Financing.date.isnot(None)) \
+        .group_by(Profile.cohort, start_year, start_month, start_day, Financing.months)
+
+    # payments grouped by (cohort, month)
+    paid_year = db.func.extract('year', Payment.date)
+    paid_month = db.func.extract('month', Payment.date)
+    payments = session.query(
+        Profile.cohort, paid_year, paid_month, db.func.sum(Payment.amount)
+    ).join(Profile, Profile.rut == Payment.rut) \
+        .filter(Payment.date.isnot(None)) \
+        .group_by(Profile.cohort, paid_year, paid_month)
+
+    cohorts = {}
+
+    def cohort_entry(cohort):
+        return cohorts.setdefault(cohort, {"contracted": Decimal(0), "changes": {}, "collected": {}, "first": None, "not_yet_due": Decimal(0)})
+
+    # a plan adds its fee every month for `months` months, starting with the month of its first
+    # installment (same rule as Financing.schedule): record it as a +fee/-fee difference pair and
+    # rebuild the monthly series with one running sum per cohort
+    for cohort, year, month, day, months, fees in plans:
+        entry = cohort_entry(cohort)
+        fees = Decimal(fees or 0)
+        first_due = month_index(year, month) + FIRST_DUE_OFFSET
+        entry["contracted"] += fees * months
+        entry["changes"][first_due] = entry["changes"].get(first_due, Decimal(0)) + fees
+        entry["changes"][first_due + months] = entry["changes"].get(first_due + months, Decimal(0)) - fees
+        entry["first"] = first_due if entry["first"] is None else min(entry["first"], first_due)
+        # like /financing_agreements/overdue, an installment of the current month is only due once
+        # its due date (the start day, clamped to the month length) has passed
+        if first_due <= last_month < first_due + months and min(int(day), month_days) >= until.day:
+            entry["not_yet_due"] += fees
+
+    for cohort, year, month, amount in payments:
+        entry = cohort_entry(cohort)
+        index = month_index(year, month)
+        entry["collected"][index] = entry["collected"].get(index, Decimal(0)) + Decimal(amount or 0)
+        entry["first"] = index if entry["first"] is None else min(entry["first"], index)
+
+    report = []
+    for cohort in sorted(cohorts):
+        entry = cohorts[cohort]
+        monthly_fee = Decimal(0)
+        due = Decimal(0)
+        collected = Decimal(0)
+        months = []
+
+        first = entry["first"] if entry["first"] is not None else last_month
+        for index in range(first, last_month + 1):
+            monthly_fee += entry["changes"].get(index, Decimal(0))
+            month_collected = entry["collected"].get(index, Decimal(0))
+            due += monthly_fee - (entry["not_yet_due"] if index == last_month else 0)
+            collected += month_collected
+            months.append({
+                "month": month_label(index),
+                "expected": str(monthly_fee),
+                "collected": str(month_collected),
+                "arrears": str(max(due - collected, Decimal(0))),
+                "collection_rate": rate(collected, due)
+            })
+
+        report.append({
+            "cohort": cohort,
+            "expected_revenue": str(entry["contracted"]),
+            "due_to_date": str(due),
+            "collected": str(collected),
+            "arrears": str(max(due - collected, Decimal(0))),
+            "collection_rate": rate(collected, due),
+            "months": months
+        })
+
+    return report
+
+def report_rows(report):
+    # flat rows for the CSV export
+    for cohort in report:
+        for month in cohort["months"]:
+            yield dict(cohort=cohort["cohort"], **month)
@@ -0,0 +1,46 @@
+"""
+Chilean RUT handling: every rut is stored and compared in the canonical form 12345678-5
+"""
+import re
+from functools import lru_cache
+
+RUT_PATTERN = re.compile(r'^0*(\d{1,8})([0-9K])$')
+
+def check_digit(body):
+    # modulo 11 with the 2..7 weight cycle
+    total = 0
+    factor = 2
+    for digit in reversed(body):
+        total += int(digit) * factor
+        factor = factor + 1 if factor < 7 else 2
+    rest = 11 - total % 11
+    if rest == 11:
+        return '0'
+    if rest == 10:
+        return 'K'
+    return str(rest)
+
+@lru_cache(maxsize=65536)
+def _canonical(text):
+    match = RUT_PATTERN.match(text)
+    if not match:
+        return None
+    body, digit = match.groups()
+    if check_digit(body) != digit:
+        return None
+    return "{}-{}".format(body, digit)
+
+def normalize_rut(value):
+    # "12.345.678-5", "12345678-5", "123456785" and 123456785 all give "12345678-5";
+    # None when the value is not a rut or its check digit is wrong
+    if value is None or isinstance(value, bool):
+        return None
+    text = str(value).strip().upper().replace('.', '').replace('-', '').replace(' ', '')
+    return _canonical(text)
+
+def validate_ruts(values):
+    # bulk version for imports: canonical ruts in input order plus the positions that failed;
+    # repeated ruts in a file are validated once thanks to the cache
+    canonical = [normalize_rut(value) for value in values]
+    invalid = [index for index, value in enumerate(canonical) if value is None]
+    return canonical, invalid
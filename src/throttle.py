@@ -0,0 +1,87 @@
+"""
+Token bucket limiter for the login endpoints, shared by every gunicorn worker through a local SQLite file
+"""
+import os
+import time
+import random
+import sqlite3
+import tempfile
+import threading
+
+PRUNE_PROBABILITY = 0.001
+
+def client_ip(request):
+    # X-Forwarded-For is resolved by ProxyFix for the TRUSTED_PROXIES hops configured in main.py;
+    # a client can write anything in that header, so it is never read here directly
+    return request.remote_addr
+
+class LoginThrottle:
+
+    def __init__(self, path, email_per_minute=5, ip_per_minute=30):
+        self.path = path
+        self.rates = {
+            "email": email_per_minute,
+            "ip": ip_per_minute
+        }
+        self._local = threading.local()
+
+    @classmethod
+    def from_env(cls):
+        path = os.environ.get('LOGIN_THROTTLE_PATH', os.path.join(tempfile.gettempdir(), 'login_throttle.sqlite3'))
+        email_per_minute = int(os.environ.get('LOGIN_EMAIL_PER_MINUTE', 5))
+        ip_per_minute = int(os.environ.get('LOGIN_IP_PER_MINUTE', 30))
+        return cls(path, email_per_minute, ip_per_minute)
+
+    def _connection(self):
+        # sqlite connections can not cross threads or forks, keep one per thread and process
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def allow(self, email, ip):
+        buckets = [("email:" + email.strip().lower(), self.rates["email"]), ("ip:" + str(ip), self.rates["ip"])]
+        now = time.time()
+        conn = self._connection()
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            levels = []
+            for key, per_minute in buckets:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = per_minute if row is None else min(per_minute, row[0] + (now - row[1]) * per_minute / 60.0)
+                levels.append((key, tokens))
+
+            # an attempt must fit in every bucket, otherwise nothing is consumed
+            allowed = all(tokens >= 1 for key, tokens in levels)
+            for key, tokens in levels:
+                conn.execute(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                    (key, tokens - 1 if allowed else tokens, now)
+                )
+            counter = "allowed" if allowed else "rejected"
+            conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)", (counter,))
+            conn.execute("UPDATE counters SET value = value + 1 WHERE name = ?", (counter,))
+
+            if random.random() < PRUNE_PROBABILITY:
+                # a bucket untouched for a minute is full again, same as a missing one
+                conn.execute("DELETE FROM buckets WHERE updated < ?", (now - 60,))
+
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        return allowed
+
+    def stats(self):
+        counters = dict(self._connection().execute("SELECT name, value FROM counters").fetchall())
+        return {
+            "allowed": counters.get("allowed", 0),
+            "rejected": counters.get("rejected", 0)
+        }
@@ -1,4 +1,26 @@
-from flask import jsonify, url_for
+import io
+import re
+import csv
+import codecs
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from sqlalchemy import Boolean, Integer, DateTime
+from flask import jsonify, url_for, request, json, Response, stream_with_context
+from rut import normalize_rut
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+STREAM_BATCH_SIZE = 1000
+MAX_BULK_ROWS = 1000
+IMPORT_CHUNK_SIZE = 500
+IN_CHUNK_SIZE = 1000
+MAX_MULTI_GET = 1000
+MULTI_GET_CHUNK_SIZE = 100
 
 class APIException(Exception):
     status_code = 400
@@ -15,6 +37,369 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+def requested_fields(model):
+    # ?fields=id,name,cohort -> ["id", "name", "cohort"]; None when the parameter is absent
+    value = request.args.get('fields', None)
+    if value is None:
+        return None
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    if not fields:
+        raise APIException('fields must name at least one field', status_code=400, payload={"allowed": list(model.FIELDS)})
+    unknown = [field for field in fields if field not in model.FIELDS]
+    if unknown:
+        raise APIException('Unknown fields: {}'.format(', '.join(unknown)), status_code=400, payload={"allowed": list(model.FIELDS)})
+    return fields
+
+def field_source(model, field):
+    source = model.FIELDS[field]
+    return source if isinstance(source, tuple) else (source, None)
+
+def select_fields(query, model, fields, extra=()):
+    # Only the requested columns are selected, the id first because the keyset needs it.
+    # Extra columns go last, after the ones row_serializer reads, and are labelled so a
+    # column that is also a field is not folded into one by the select.
+    columns = [model.id] + [getattr(model, field_source(model, field)[0]) for field in fields if field != 'id']
+    columns += [column.label('extra_{}'.format(index)) for index, column in enumerate(extra)]
+    return query.with_entities(*columns)
+
+def row_serializer(model, fields):
+    # Builds the serialize() dicts straight from the row tuples of select_fields, so read
+    # endpoints never create ORM objects or go through the identity map.
+    sources = []
+    position = 0
+    for field in fields:
+        if field != 'id':
+            position += 1
+        sources.append((field, 0 if field == 'id' else position, field_source(model, field)[1]))
+
+    def serialize(row):
+        item = {}
+        for field, index, formatter in sources:
+            value = row[index]
+            item[field] = formatter(value) if formatter else value
+        return item
+    return serialize
+
+def fetch_rows(query):
+    # the query is only used to build the statement, rows come back from Core without ORM loading
+    return query.session.execute(query.statement).fetchall()
+
+def requested_includes(model):
+    # ?include=payments,invoices -> ["payments", "invoices"], the names a model allows are its INCLUDES
+    value = request.args.get('include', None)
+    if value is None:
+        return []
+    allowed = getattr(model, 'INCLUDES', {})
+    includes = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in includes if name not in allowed]
+    if unknown:
+        raise APIException('Unknown include: {}'.format(', '.join(unknown)), status_code=400, payload={"allowed": list(allowed)})
+    return includes
+
+def include_relation(model, name):
+    # (related model, parent column, related column, one or many) of the relationship behind an include
+    relation = getattr(model, model.INCLUDES[name]).property
+    local, remote = relation.local_remote_pairs[0]
+    return relation.mapper.class_, local, remote, relation.uselist
+
+def include_keys(model, includes):
+    return [include_relation(model, name)[1] for name in includes]
+
+def attach_includes(model, includes, items, keys):
+    # Selectin style loading: one IN query per include (per IN_CHUNK_SIZE parents), whatever the
+    # number of items. keys[i] has the parent column value of every include for items[i].
+    for position, name in enumerate(includes):
+        related, local, remote, many = include_relation(model, name)
+        fields = list(related.FIELDS)
+        serialize = row_serializer(related, fields)
+        values = list({key[position] for key in keys if key[position] is not None})
+
+        groups = {}
+        for start in range(0, len(values), IN_CHUNK_SIZE):
+            query = select_fields(related.query, related, fields, [remote]) \
+                .filter(remote.in_(values[start:start + IN_CHUNK_SIZE])).order_by(related.id)
+            for row in fetch_rows(query):
+                groups.setdefault(row[-1], []).append(serialize(row))
+
+        for item, key in zip(items, keys):
+            matches = groups.get(key[position], [])
+            item[name] = matches if many else (matches[0] if matches else None)
+    return items
+
+def shape_item(item, model):
+    # item GETs come from the entity cache already serialized: the fields are picked from the
+    # cached dict and the includes are loaded on a copy, so the cache entry is never changed
+    fields = requested_fields(model)
+    includes = requested_includes(model)
+    shaped = dict(item) if fields is None else {field: item[field] for field in fields}
+    if includes:
+        keys = [tuple(item[column.key] for column in include_keys(model, includes))]
+        attach_includes(model, includes, [shaped], keys)
+    return shaped
+
+def dumps(value):
+    # orjson when it is installed, stdlib through flask otherwise; bytes either way
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value).encode('utf-8')
+
+def json_response(value):
+    return Response(dumps(value), mimetype='application/json')
+
+def parse_filter_value(column, param, value):
+    if isinstance(column.type, Boolean):
+        if value.lower() in ('true', '1'):
+            return True
+        if value.lower() in ('false', '0'):
+            return False
+    elif isinstance(column.type, Integer):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    else:
+        return value
+    raise APIException('Invalid value for {}: {}'.format(param, value), status_code=400)
+
+def parse_filter_date(param, value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d' if len(value) == 10 else '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        raise APIException('{} must be a date (YYYY-MM-DD) or a datetime (YYYY-MM-DDTHH:MM:SS)'.format(param), status_code=400)
+
+def filter_criteria(model, args):
+    # The model's FILTERS turned into WHERE clauses: equality on the column, or a range for DateTime
+    # columns, where ?<param>_to= with a plain date includes that whole day.
+    criteria = []
+    for param, attr in getattr(model, 'FILTERS', {}).items():
+        column = model.__table__.c[attr]
+        if isinstance(column.type, DateTime):
+            start = args.get(param + '_from')
+            end = args.get(param + '_to')
+            if start:
+                criteria.append(column >= parse_filter_date(param + '_from', start))
+            if end:
+                until = parse_filter_date(param + '_to', end)
+                criteria.append(column < until + timedelta(days=1) if len(end) == 10 else column <= until)
+        elif param in args:
+            criteria.append(column == parse_filter_value(column, param, args[param]))
+    return criteria
+
+# ?param -> the unique column it looks up and how each value is parsed; a model supports the
+# ones whose column exists and is unique
+MULTI_GET_PARAMS = [
+    ("ids", "id", int),
+    ("breathecode_ids", "breathecode_id", int),
+    ("emails", "email", str.strip),
+    ("ruts", "rut", normalize_rut)
+]
+
+def match_key(value):
+    # emails can come back with another case on case insensitive collations
+    return value.lower() if isinstance(value, str) else value
+
+def multi_get(query, model):
+    # ?ids=3,1,2 (or one of the alternate keys) -> {"results": [...], "missing": [...]}, results in
+    # the requested order. None when the request is not a multi-get.
+    present = [entry for entry in MULTI_GET_PARAMS if entry[0] in request.args]
+    if not present:
+        return None
+    if len(present) > 1:
+        raise APIException('Use only one of {}'.format(', '.join(entry[0] for entry in present)), status_code=400)
+    param, attr, parse = present[0]
+    column = model.__table__.c.get(attr)
+    if column is None or not (column.primary_key or column.unique):
+        raise APIException('{} is not supported on this endpoint'.format(param), status_code=400)
+
+    parsed = []
+    for raw in request.args[param].split(','):
+        if not raw.strip():
+            continue
+        try:
+            value = parse(raw.strip())
+        except ValueError:
+            value = None
+        if value is None:
+            raise APIException('Invalid value in {}: {}'.format(param, raw.strip()), status_code=400)
+        parsed.append(value)
+    values = list(dict.fromkeys(parsed))
+    if not values:
+        raise APIException('{} is empty'.format(param), status_code=400)
+    if len(values) > MAX_MULTI_GET:
+        raise APIException('A multi-get can not ask for more than {} values'.format(MAX_MULTI_GET), status_code=400)
+
+    fields = requested_fields(model) or list(model.FIELDS)
+    includes = requested_includes(model)
+    serialize = row_serializer(model, fields)
+    query = select_fields(query, model, fields, [column] + include_keys(model, includes))
+    position = -1 - len(includes)
+
+    # one IN query per chunk of values, each one a lookup on the unique index
+    found = {}
+    for start in range(0, len(values), MULTI_GET_CHUNK_SIZE):
+        chunk = values[start:start + MULTI_GET_CHUNK_SIZE]
+        for row in fetch_rows(query.filter(column.in_(chunk))):
+            found[match_key(row[position])] = row
+
+    rows = [found[match_key(value)] for value in values if match_key(value) in found]
+    items = list(map(serialize, rows))
+    if includes:
+        attach_includes(model, includes, items, [row[len(row) - len(includes):] for row in rows])
+
+    return {
+        "results": items,
+        "missing": [value for value in values if match_key(value) not in found]
+    }
+
+def int_arg(param):
+    # request.args.get(type=int) turns ?limit=abc into None, which would read as "no pagination"
+    value = request.args.get(param, None)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise APIException('{} must be an integer'.format(param), status_code=400)
+
+def paginate(query, model):
+    # Keyset pagination on the primary key: ?limit=N&after=<last id seen>.
+    # Every page is an indexed range scan, so deep pages cost the same as the first one.
+    # Without limit/after the whole collection is returned as a plain list, like before.
+    limit = int_arg('limit')
+    after = int_arg('after')
+    fields = requested_fields(model) or list(model.FIELDS)
+    includes = requested_includes(model)
+    serialize = row_serializer(model, fields)
+
+    def serialize_rows(rows):
+        items = list(map(serialize, rows))
+        if includes:
+            attach_includes(model, includes, items, [row[len(row) - len(includes):] for row in rows])
+        return items
+
+    query = select_fields(query, model, fields, include_keys(model, includes)) \
+        .filter(*filter_criteria(model, request.args)).order_by(model.id)
+    if limit is None and after is None:
+        return serialize_rows(fetch_rows(query))
+
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    if limit < 1:
+        raise APIException('limit must be a positive integer', status_code=400)
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    if after is not None:
+        query = query.filter(model.id > after)
+
+    # fetch one extra row to know if there is a next page without a COUNT(*)
+    rows = fetch_rows(query.limit(limit + 1))
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+
+    return {
+        "results": serialize_rows(rows),
+        "next": rows[-1][0] if has_next else None
+    }
+
+def wants_stream():
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson'])
+    return best == 'application/x-ndjson'
+
+def stream_ndjson(query, model):
+    # One JSON document per line, written as soon as each row is serialized.
+    # stream_results asks the driver for a server-side cursor and rows are fetched
+    # in batches, so memory does not grow with the table.
+    after = int_arg('after')
+    fields = requested_fields(model) or list(model.FIELDS)
+    includes = requested_includes(model)
+    serialize = row_serializer(model, fields)
+    query = select_fields(query, model, fields, include_keys(model, includes)) \
+        .filter(*filter_criteria(model, request.args)).order_by(model.id)
+    if after is not None:
+        query = query.filter(model.id > after)
+    statement = query.statement.execution_options(stream_results=True)
+    session = query.session
+
+    def generate():
+        result = session.execute(statement)
+        while True:
+            rows = result.fetchmany(STREAM_BATCH_SIZE)
+            if not rows:
+                break
+            items = list(map(serialize, rows))
+            if includes:
+                attach_includes(model, includes, items, [row[len(row) - len(includes):] for row in rows])
+            for item in items:
+                yield dumps(item) + b"\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def read_bulk_rows():
+    # Bulk endpoints take either a JSON array of objects or a CSV with a header row,
+    # sent as the request body (text/csv) or as a multipart "file" upload.
+    if 'file' in request.files:
+        text = request.files['file'].read().decode('utf-8-sig')
+        rows = list(csv.DictReader(io.StringIO(text)))
+    elif request.mimetype == 'text/csv':
+        rows = list(csv.DictReader(io.StringIO(request.get_data(as_text=True))))
+    else:
+        rows = request.get_json(silent=True)
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise APIException('Expected a JSON array of objects or a CSV file', status_code=400)
+
+    if not rows:
+        raise APIException('No rows to import', status_code=400)
+    if len(rows) > MAX_BULK_ROWS:
+        raise APIException('A bulk request can not have more than {} rows'.format(MAX_BULK_ROWS), status_code=400)
+    return rows
+
+def iter_csv_chunks(chunk_size=IMPORT_CHUNK_SIZE):
+    # Reads the CSV line by line straight from the upload and yields lists of row dicts,
+    # so an import only ever holds one chunk in memory.
+    if 'file' in request.files:
+        stream = request.files['file'].stream
+    elif request.mimetype == 'text/csv':
+        stream = request.stream
+    else:
+        raise APIException('Expected a CSV file', status_code=400)
+
+    chunk = []
+    for row in csv.DictReader(codecs.iterdecode(stream, 'utf-8-sig')):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+THOUSANDS_WITH_DOTS = re.compile(r'^-?\d{1,3}(\.\d{3})+$')
+
+def parse_money(value):
+    # Accepts numbers and the strings people type, e.g. "15000", "$15.000", "15.000,50" or "15000.50".
+    # Returns a Decimal or None when the value is not an amount.
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float, Decimal)):
+        return Decimal(str(value))
+    if not isinstance(value, str):
+        return None
+
+    text = value.replace('$', '').replace(' ', '').strip()
+    if '.' in text and ',' in text:
+        text = text.replace('.', '').replace(',', '.')
+    elif ',' in text:
+        text = text.replace(',', '.')
+    elif THOUSANDS_WITH_DOTS.match(text):
+        text = text.replace('.', '')
+
+    try:
+        amount = Decimal(text)
+    except InvalidOperation:
+        return None
+    return amount if amount.is_finite() else None
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()